@@ -1,79 +1,177 @@
 from __future__ import annotations
 
-import math
+import threading
 import traceback
-from typing import Any, Dict, List, Literal, Optional
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple
 
 import numpy as np
+import orjson
 import pandas as pd
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ConfigDict
 import uvicorn
 
 from source.app.agents.chat_agent import ChatAgent
+from source.app.core.llm import close_http_client
+from source.app.core.utils import df_to_records
 
-app = FastAPI(title="Olist Chatbot API", version="1.0.0")
 
-# Lazy init: avoid crashing on import/startup due to missing env/files
-_agent: Optional[ChatAgent] = None
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up once per worker (env, DB, LLM/Qdrant clients) before the first
+    # request is accepted, instead of lazily inside /chat.
+    app.state.agent = ChatAgent()
+    app.state.sessions = SessionStore()
+    yield
+    app.state.agent.close()
+    # pool HTTP OpenAI dibagi semua agent di proses ini -> ditutup paling akhir
+    close_http_client()
 
 
-def get_agent() -> ChatAgent:
-    global _agent
-    if _agent is None:
-        _agent = ChatAgent()
-    return _agent
+# batas body setelah dekompresi (history + state jauh di bawah ini); di atasnya -> 413
+MAX_BODY_BYTES = 8 * 1024 * 1024
 
 
-def _is_bad_float(x: float) -> bool:
-    return math.isnan(x) or math.isinf(x)
+def _gunzip_bounded(data: bytes, limit: int = MAX_BODY_BYTES) -> bytes:
+    """Dekompres gzip bertahap dengan batas ukuran output (anti gzip bomb)."""
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        out = d.decompress(data, limit + 1)
+        if len(out) > limit:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        if not d.eof:
+            raise HTTPException(status_code=400, detail="Truncated gzip body")
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Invalid gzip body")
+    return out
+
+
+class GzipRequest(Request):
+    """Request body dengan Content-Encoding: gzip (client kirim history/state besar terkompresi)."""
+
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            body = await super().body()
+            if "gzip" in self.headers.getlist("Content-Encoding"):
+                body = _gunzip_bounded(body)
+            self._body = body
+        return self._body
+
+
+class GzipRoute(APIRoute):
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def custom_route_handler(request: Request) -> Response:
+            return await original_route_handler(GzipRequest(request.scope, request.receive))
+
+        return custom_route_handler
+
+
+app = FastAPI(
+    title="Olist Chatbot API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+# route_class harus di-set sebelum endpoint didefinisikan
+app.router.route_class = GzipRoute
+# show_debug payloads (tool_outputs + previews) are 10-100 KB of JSON
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
-def sanitize(obj: Any) -> Any:
+_ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _fallback(obj: Any) -> Any:
     """
-    Convert non-JSON-serializable objects (DataFrame, numpy scalars, NaN/Inf)
-    into JSON-friendly shapes.
+    orjson ``default=`` hook: only called for objects orjson can't encode itself.
+    numpy scalars/arrays, NaN/Inf (-> null) and non-str keys are handled in C.
     """
-    if obj is None:
+    # Hot case first: per-cell Timestamps from datetime preview columns.
+    # Exact type() check, before the DataFrame/Series isinstance ladder.
+    if type(obj) is pd.Timestamp:
+        return obj.isoformat()
+    # NA singletons (NaN floats are already null via orjson)
+    if obj is pd.NaT or obj is pd.NA:
         return None
 
-    if isinstance(obj, float):
-        return None if _is_bad_float(obj) else obj
-
-    if isinstance(obj, (np.integer,)):
-        return int(obj)
-    if isinstance(obj, (np.bool_,)):
-        return bool(obj)
-    if isinstance(obj, (np.floating,)):
-        x = float(obj)
-        return None if _is_bad_float(x) else x
-
     if isinstance(obj, pd.DataFrame):
-        preview = obj.head(50).copy()
-        preview = preview.replace([np.nan, np.inf, -np.inf], None)
+        preview = obj.head(50)
         return {
             "_type": "dataframe",
             "shape": [int(obj.shape[0]), int(obj.shape[1])],
             "columns": preview.columns.tolist(),
-            "rows": preview.to_dict(orient="records"),
+            "rows": df_to_records(preview),
         }
 
     if isinstance(obj, pd.Series):
-        s = obj.head(50).replace([np.nan, np.inf, -np.inf], None)
-        return {"_type": "series", "name": obj.name, "values": s.tolist()}
+        # no .replace(): it copies to object dtype; orjson nulls NaN/Inf anyway
+        return {"_type": "series", "name": obj.name, "values": obj.head(50).tolist()}
 
-    try:
-        if pd.isna(obj):
-            return None
-    except Exception:
-        pass
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    return str(obj)
+
+
+def json_response(content: Any) -> Response:
+    """Serialize in one C-level pass (no Python pre-walk, no jsonable_encoder)."""
+    return Response(
+        content=orjson.dumps(content, option=_ORJSON_OPTS, default=_fallback),
+        media_type="application/json",
+    )
 
-    if isinstance(obj, dict):
-        return {str(k): sanitize(v) for k, v in obj.items()}
-    if isinstance(obj, (list, tuple)):
-        return [sanitize(x) for x in obj]
 
-    return obj
+# Server-side history (per worker) is the source of truth: a client with a session_id
+# sends no history. Unknown session_id (other worker / restart / new instance) -> 409,
+# and the client resends once with its own capped history to start a new session.
+MAX_SESSIONS = 1000
+MAX_SESSION_MESSAGES = 12  # same window as the Streamlit client (HISTORY_WINDOW)
+
+
+class SessionStore:
+    """LRU of session_id -> history. Shared by the async /chat handler and the
+    threadpool-run /chat/stream generator, so every access goes through a lock."""
+
+    def __init__(self) -> None:
+        self._sessions: OrderedDict[str, List[Dict[str, str]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: Optional[str]) -> Optional[List[Dict[str, str]]]:
+        """Copy of the stored history (and mark it recently used), or None if unknown."""
+        if not session_id:
+            return None
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                return None
+            self._sessions.move_to_end(session_id)
+            return list(history)
+
+    def remember_turn(
+        self,
+        session_id: str,
+        history: List[Dict[str, str]],
+        user_message: str,
+        answer: str,
+    ) -> None:
+        turns = history + [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": answer},
+        ]
+        with self._lock:
+            self._sessions[session_id] = turns[-MAX_SESSION_MESSAGES:]
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
 
 
 class ChatMessage(BaseModel):
@@ -82,11 +180,44 @@ class ChatMessage(BaseModel):
 
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     message: str
     history: Optional[List[ChatMessage]] = []
     answer_lang: Literal["id", "en"] = "id"
     show_debug: bool = False
     state: Dict[str, Any] = {}
+    session_id: Optional[str] = None
+
+
+def _resolve_session(sessions: SessionStore, req: "ChatRequest") -> Tuple[str, List[Dict[str, str]]]:
+    stored = sessions.get(req.session_id)
+    if stored is not None:
+        return req.session_id, stored
+    if req.session_id and not req.history:
+        # client relies on a session this worker doesn't have; it retries with history
+        raise HTTPException(status_code=409, detail="Unknown session_id; resend with history")
+    # new session (or the client's retry): start from client history
+    history = [{"role": m.role, "content": m.content} for m in (req.history or [])]
+    return uuid.uuid4().hex, history
+
+
+def _chat_body(out: Dict[str, Any], session_id: str, show_debug: bool) -> Dict[str, Any]:
+    resp: Dict[str, Any] = {
+        "final_answer": str(out.get("final_answer", "")),
+        "used_tools": out.get("used_tools") or [],
+        "state": out.get("state") or {},
+        "session_id": session_id,
+    }
+    if show_debug:
+        resp["tool_outputs"] = out.get("tool_outputs")
+        resp["debug"] = out.get("debug") or {}
+    return resp
+
+
+def _sse(event: Dict[str, Any]) -> bytes:
+    # satu frame SSE per event; orjson tidak menghasilkan newline, jadi cukup satu baris data:
+    return b"data: " + orjson.dumps(event, option=_ORJSON_OPTS, default=_fallback) + b"\n\n"
 
 
 @app.get("/health")
@@ -94,18 +225,20 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/chat")
-def chat(req: ChatRequest):
+@app.post("/chat", response_model=None, response_class=ORJSONResponse)
+async def chat(req: ChatRequest, request: Request):
     """
     Chat endpoint (SAFE).
-    We sanitize output to avoid DataFrame / NaN / numpy types issues.
+    DataFrame / NaN / numpy types are handled by the orjson fallback hook.
     """
-    try:
-        history = [{"role": m.role, "content": m.content} for m in (req.history or [])]
+    # outside the try: the 409 for an unknown session must not become a 500
+    sessions: SessionStore = request.app.state.sessions
+    session_id, history = _resolve_session(sessions, req)
 
-        agent = get_agent()
+    try:
+        agent: ChatAgent = request.app.state.agent
 
-        out = agent.chat(
+        out = await agent.achat(
             user_message=req.message,
             history=history,
             answer_lang=req.answer_lang,
@@ -113,23 +246,62 @@ def chat(req: ChatRequest):
             show_debug=req.show_debug,
         )
 
-        resp: Dict[str, Any] = {
-            "final_answer": str(out.get("final_answer", "")),
-            "used_tools": out.get("used_tools") or [],
-            "state": out.get("state") or {},
-        }
+        resp = _chat_body(out, session_id, req.show_debug)
+        sessions.remember_turn(session_id, history, req.message, resp["final_answer"])
 
-        if req.show_debug:
-            resp["tool_outputs"] = out.get("tool_outputs")
-            resp["debug"] = out.get("debug") or {}
-        
-        return sanitize(resp)
+        return json_response(resp)
 
     except Exception as e:
         tb = traceback.format_exc()
         raise HTTPException(status_code=500, detail=f"{e}\n\n{tb}")
 
 
+@app.post("/chat/stream")
+def chat_stream(req: ChatRequest, request: Request):
+    """
+    Server-Sent Events: `data: {"delta": "..."}` per potongan jawaban,
+    lalu `data: {"done": true, ...body /chat...}` (state, session_id, debug).
+    Error di tengah stream dikirim sebagai `data: {"error": "..."}`.
+    """
+    sessions: SessionStore = request.app.state.sessions
+    session_id, history = _resolve_session(sessions, req)
+    agent: ChatAgent = request.app.state.agent
+
+    # generator sync -> Starlette menjalankannya di threadpool (tools + LLM tetap blocking)
+    def events() -> Iterator[bytes]:
+        try:
+            for ev in agent.chat_stream(
+                user_message=req.message,
+                history=history,
+                answer_lang=req.answer_lang,
+                state=req.state,
+                show_debug=req.show_debug,
+            ):
+                if "delta" in ev:
+                    yield _sse({"delta": ev["delta"]})
+                else:
+                    resp = _chat_body(ev["result"], session_id, req.show_debug)
+                    sessions.remember_turn(session_id, history, req.message, resp["final_answer"])
+                    yield _sse({"done": True, **resp})
+        except Exception as e:
+            yield _sse({"error": f"{e}\n\n{traceback.format_exc()}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # proxy (Cloud Run / nginx) jangan buffer frame SSE
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 if __name__ == "__main__":
-    # Runs the app instance directly
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    # Runs the app instance directly (uvloop + httptools from uvicorn[standard])
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+        access_log=False,
+    )
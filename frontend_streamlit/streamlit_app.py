@@ -1,8 +1,10 @@
 import os
+import time
+from typing import Iterable, Iterator
+
 import streamlit as st
-import tiktoken
 
-from services.api_client import APIConfig, APIError, chat, health_check
+from services.api_client import APIConfig, APIError, health_check, stream_chat
 
 
 # =========================
@@ -19,11 +21,23 @@ PRICING = {
 }
 
 
+@st.cache_resource(show_spinner=False)
+def _enc(model: str):
+    # cache_resource (bukan lru_cache): script utama dieksekusi ulang tiap rerun,
+    # jadi cache biasa di sini akan ikut hilang.
+    # import lazy: tabel BPE tiktoken baru dimuat saat token pertama dihitung,
+    # bukan saat cold start container.
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
 def count_tokens(text: str, model: str = MODEL_NAME) -> int:
     if not text:
         return 0
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(text))
+    # encode_ordinary: tanpa scan special token (<|...|>), lebih cepat dan
+    # tidak raise kalau user kebetulan mengetik marker seperti itu.
+    return len(_enc(model).encode_ordinary(text))
 
 
 def estimate_cost(prompt_tokens: int, completion_tokens: int, model: str = MODEL_NAME) -> float:
@@ -34,28 +48,98 @@ def estimate_cost(prompt_tokens: int, completion_tokens: int, model: str = MODEL
     )
 
 
+@st.cache_resource(show_spinner=False)
+def make_cfg(base_url: str, timeout: int) -> APIConfig:
+    # satu APIConfig (immutable) per (base_url, timeout), bukan objek baru tiap rerun
+    return APIConfig(base_url=base_url, timeout=timeout)
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_health(base_url: str):
+    # GET /health idempoten: klik berulang / rerun dalam 30 detik tidak menembak backend lagi
+    return health_check(make_cfg(base_url, 90))
+
+
 # =========================
-# LEGACY PLACEHOLDER
+# STREAM RENDERING
 # =========================
 
-@st.cache_resource
-def get_chat_agent():
-    return None
+SMOOTH_MAX_DELTA = 50  # delta lebih panjang dari ini dipecah
+SMOOTH_PIECE = 16
+SMOOTH_DELAY_S = 0.05  # ~16 char / 50 ms (selaras dengan coalesce)
+SMOOTH_MAX_TOTAL_S = 0.5  # batas delay per delta (mis. jawaban dari LLM cache sekaligus)
+
+COALESCE_MAX_CHARS = 16
+COALESCE_INTERVAL_S = 0.05
+
+
+def coalesce(stream: Iterable[str]) -> Iterator[str]:
+    """
+    Kebalikan dari smooth: token kecil dikumpulkan dulu dan di-flush tiap ~50 ms
+    atau ~16 char, supaya markdown tidak di-render ulang untuk setiap token.
+    """
+    buf = ""
+    last_flush = time.monotonic()
+    for delta in stream:
+        buf += delta
+        if len(buf) > COALESCE_MAX_CHARS or time.monotonic() - last_flush > COALESCE_INTERVAL_S:
+            yield buf
+            buf = ""
+            last_flush = time.monotonic()
+    if buf:
+        yield buf
+
+
+def smooth(stream: Iterable[str]) -> Iterator[str]:
+    """
+    Backend kadang mengirim delta besar sekaligus (buffered); pecah jadi potongan
+    kecil supaya st.write_stream tetap terlihat mengetik, bukan diam lalu dump.
+    Potongan membesar untuk delta panjang: total delay maksimal SMOOTH_MAX_TOTAL_S.
+    """
+    max_steps = int(SMOOTH_MAX_TOTAL_S / SMOOTH_DELAY_S)
+    for delta in stream:
+        if len(delta) > SMOOTH_MAX_DELTA:
+            piece = max(SMOOTH_PIECE, -(-len(delta) // max_steps))
+            for i in range(0, len(delta), piece):
+                yield delta[i : i + piece]
+                time.sleep(SMOOTH_DELAY_S)
+        else:
+            yield delta
 
 
 # =========================
 # STATE INIT
 # =========================
 
+@st.cache_data(show_spinner=False)
+def _resolve_api_base() -> str:
+    # lookup secrets + env sekali per proses (bukan per session); script utama
+    # dieksekusi ulang tiap rerun, jadi konstanta modul biasa tidak cukup
+    api_base = None
+    try:
+        api_base = st.secrets.get("API_BASE")  # type: ignore
+    except Exception:
+        api_base = None
+    return api_base or os.getenv("API_BASE", "")
+
+
 def init_state():
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "history_backend" not in st.session_state:
+        # paralel dengan messages: {"role", "content"} siap kirim ke backend
+        st.session_state.history_backend = []
     if "answer_lang" not in st.session_state:
         st.session_state.answer_lang = "id"
     if "show_debug" not in st.session_state:
         st.session_state.show_debug = False
     if "chat_state" not in st.session_state:
+        # ChatState backend sudah kecil (preview 5 baris, 3 source) -> simpan utuh
         st.session_state.chat_state = {}
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = None
+    if "last_debug" not in st.session_state:
+        st.session_state.last_debug = None
 
     # token state
     if "prompt_tokens" not in st.session_state:
@@ -66,74 +150,85 @@ def init_state():
         st.session_state.total_cost = 0.0
 
     if "api_base" not in st.session_state:
-        api_base = None
-        try:
-            api_base = st.secrets.get("API_BASE")  # type: ignore
-        except Exception:
-            api_base = None
-        if not api_base:
-            api_base = os.getenv("API_BASE", "")
-        st.session_state.api_base = api_base
+        st.session_state.api_base = _resolve_api_base()
+
+
+# history maksimal yang dikirim ke backend (message dict terbaru), supaya
+# ukuran request + prompt token tidak tumbuh terus sepanjang session
+HISTORY_WINDOW = 12
+
+
+def _append_message(role: str, content: str) -> None:
+    # satu tempat append -> history_backend selalu sinkron dengan messages
+    m = {"role": role, "content": content}
+    st.session_state.messages.append(m)
+    st.session_state.history_backend.append(m)
 
 
 def _history_for_backend() -> list[dict]:
-    history = []
-    for m in st.session_state.messages:
-        if isinstance(m, dict) and "role" in m and "content" in m:
-            history.append({"role": m["role"], "content": m["content"]})
-    return history
+    # dibangun incremental di _append_message, bukan walk ulang messages tiap turn
+    return st.session_state.history_backend
 
 
-# =========================
-# MAIN APP
-# =========================
+@st.fragment
+def render_history():
+    # fragment: bisa di-rerun sendiri tanpa ikut menjalankan ulang sidebar/input
+    for m in st.session_state.messages:
+        with st.chat_message(m["role"]):
+            st.markdown(m["content"])
 
-def main():
-    st.set_page_config(page_title="Olist Chat (Cloud Run)", layout="wide")
-    init_state()
 
-    st.title("💬 Olist Chat (Cloud Run)")
-    st.caption("Streamlit frontend → Cloud Run backend (`/chat`).")
+@st.fragment
+def render_debug():
+    # hanya response terakhir; expander collapsed -> JSON besar tidak langsung dirender
+    if not st.session_state.show_debug or not st.session_state.last_debug:
+        return
+    with st.expander("Debug", expanded=False):
+        st.json(st.session_state.last_debug)
 
-    # =========================
-    # SIDEBAR
-    # =========================
 
-    st.sidebar.header("Settings")
+@st.fragment
+def render_sidebar():
+    # dipanggil di dalam `with st.sidebar:` (fragment tidak boleh memanggil st.sidebar langsung)
+    st.header("Settings")
 
-    st.session_state.api_base = st.sidebar.text_input(
+    st.session_state.api_base = st.text_input(
         "Cloud Run Base URL",
         value=st.session_state.api_base,
         placeholder="https://<service>.run.app",
     )
 
-    st.session_state.answer_lang = st.sidebar.selectbox(
+    st.session_state.answer_lang = st.selectbox(
         "Answer language",
         ["id", "en"],
         index=0 if st.session_state.answer_lang == "id" else 1,
     )
 
-    st.session_state.show_debug = st.sidebar.checkbox(
+    st.session_state.show_debug = st.checkbox(
         "Show debug",
         value=st.session_state.show_debug,
     )
 
-    cfg = APIConfig(base_url=st.session_state.api_base, timeout=90)
+    cfg = make_cfg(st.session_state.api_base, 90)
 
-    c1, c2 = st.sidebar.columns(2)
+    # Health check hanya rerun fragment ini; Clear chat -> st.rerun() full app
+    c1, c2 = st.columns(2)
     with c1:
         if st.button("Check /health"):
             if not cfg.base_url:
-                st.sidebar.error("API_BASE belum diisi.")
+                st.error("API_BASE belum diisi.")
             else:
-                code, body = health_check(cfg)
-                st.sidebar.write("Status:", code)
-                st.sidebar.write(body)
+                code, body = _cached_health(cfg.base_url)
+                st.write("Status:", code)
+                st.write(body)
 
     with c2:
         if st.button("Clear chat"):
             st.session_state.messages = []
+            st.session_state.history_backend = []
             st.session_state.chat_state = {}
+            st.session_state.session_id = None
+            st.session_state.last_debug = None
             st.session_state.prompt_tokens = 0
             st.session_state.completion_tokens = 0
             st.session_state.total_cost = 0.0
@@ -143,72 +238,99 @@ def main():
     # TOKEN SIDEBAR
     # =========================
 
-    st.sidebar.divider()
-    st.sidebar.header("🔢 Token Usage (Estimated)")
+    st.divider()
+    st.header("🔢 Token Usage (Estimated)")
 
-    st.sidebar.metric("Prompt Tokens", st.session_state.prompt_tokens)
-    st.sidebar.metric("Completion Tokens", st.session_state.completion_tokens)
-    st.sidebar.metric(
+    st.metric("Prompt Tokens", st.session_state.prompt_tokens)
+    st.metric("Completion Tokens", st.session_state.completion_tokens)
+    st.metric(
         "Total Tokens",
         st.session_state.prompt_tokens + st.session_state.completion_tokens,
     )
 
-    st.sidebar.divider()
-    st.sidebar.header("💰 Cost Estimation (USD)")
-    st.sidebar.metric("Estimated Cost", f"${st.session_state.total_cost:.6f}")
+    st.divider()
+    st.header("💰 Cost Estimation (USD)")
+    st.metric("Estimated Cost", f"${st.session_state.total_cost:.6f}")
+
+
+# =========================
+# MAIN APP
+# =========================
+
+def main():
+    st.set_page_config(page_title="Olist Chat (Cloud Run)", layout="wide")
+    init_state()
+
+    st.title("💬 Olist Chat (Cloud Run)")
+    st.caption("Streamlit frontend → Cloud Run backend (`/chat/stream`).")
 
     # =========================
-    # CHAT HISTORY
+    # SIDEBAR
     # =========================
 
-    for m in st.session_state.messages:
-        with st.chat_message(m["role"]):
-            st.markdown(m["content"])
+    # fragment: edit URL / bahasa / health check hanya rerun sidebar,
+    # main pane baru membaca nilainya (dari session_state) di rerun berikutnya
+    with st.sidebar:
+        render_sidebar()
+
+    cfg = make_cfg(st.session_state.api_base, 90)
 
     # =========================
     # CHAT INPUT
     # =========================
 
+    # chat_input tetap ter-pin di bawah; dibaca dulu supaya pesan user baru
+    # langsung masuk history dan dirender sekali oleh render_history()
     user_msg = st.chat_input("Ketik pertanyaanmu...")
     if user_msg:
         if not cfg.base_url:
             st.error("API_BASE kosong. Isi dulu URL Cloud Run di sidebar.")
             st.stop()
+        _append_message("user", user_msg)
+        st.session_state.last_debug = None
 
-        st.session_state.messages.append({"role": "user", "content": user_msg})
+    # =========================
+    # CHAT HISTORY
+    # =========================
 
-        with st.chat_message("user"):
-            st.markdown(user_msg)
+    render_history()
+    render_debug()
 
+    if user_msg:
+        answered = False
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
                 try:
-                    out = chat(
+                    # token jawaban dirender begitu datang (SSE); event "done" terakhir
+                    # (state, session_id, debug) diisi ke `out`
+                    out: dict = {}
+                    stream = stream_chat(
                         cfg=cfg,
                         message=user_msg,
-                        history=_history_for_backend(),
+                        # history sebelum pesan ini (pesannya ada di `message`); api_client
+                        # hanya mengirimnya kalau backend belum / tidak lagi kenal session_id
+                        history=_history_for_backend()[-HISTORY_WINDOW - 1 : -1],
                         answer_lang=st.session_state.answer_lang,
                         show_debug=st.session_state.show_debug,
                         state=st.session_state.chat_state,
+                        session_id=st.session_state.session_id,
+                        final=out,
                     )
+                    answer = st.write_stream(smooth(coalesce(stream)))
+                    if not isinstance(answer, str):
+                        answer = "".join(map(str, answer or []))
+                    answer = answer or out.get("final_answer") or "(no final_answer)"
+                    st.session_state.session_id = out.get("session_id") or st.session_state.session_id
 
-                    answer = out.get("final_answer", "(no final_answer)")
-                    st.markdown(answer)
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": answer}
-                    )
+                    _append_message("assistant", answer)
 
                     # =========================
                     # TOKEN COUNTING
                     # =========================
 
-                    prompt_text = "\n".join(
-                        m["content"]
-                        for m in st.session_state.messages
-                        if m["role"] == "user"
-                    )
-
-                    prompt_tokens = count_tokens(prompt_text)
+                    # delta saja: counter kumulatif ada di session_state,
+                    # jadi history lama tidak perlu di-tokenize ulang tiap turn
+                    prompt_tokens = count_tokens(user_msg)
                     completion_tokens = count_tokens(answer)
                     cost = estimate_cost(prompt_tokens, completion_tokens)
 
@@ -224,27 +346,29 @@ def main():
                         st.session_state.chat_state = out["state"]
 
                     if st.session_state.show_debug:
-                        st.divider()
-                        st.subheader("Debug")
-                        st.json(
-                            {
-                                "used_tools": out.get("used_tools", []),
-                                "debug": out.get("debug", {}),
-                                "state": out.get("state", {}),
-                                "tool_outputs": out.get("tool_outputs", {}),
-                                "tokens": {
-                                    "prompt": prompt_tokens,
-                                    "completion": completion_tokens,
-                                    "cost_usd": cost,
-                                },
-                            }
-                        )
+                        st.session_state.last_debug = {
+                            "used_tools": out.get("used_tools", []),
+                            "debug": out.get("debug", {}),
+                            "state": out.get("state", {}),
+                            "tool_outputs": out.get("tool_outputs", {}),
+                            "tokens": {
+                                "prompt": prompt_tokens,
+                                "completion": completion_tokens,
+                                "cost_usd": cost,
+                            },
+                        }
+                    answered = True
 
                 except APIError as e:
                     st.error(str(e))
                 except Exception as e:
                     st.exception(e)
 
+        # di luar try: st.rerun() memakai exception internal Streamlit.
+        # Rerun -> turn baru dirender sekali dari history, sidebar token/cost ikut ter-update.
+        if answered:
+            st.rerun()
+
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,12 @@
+import re
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+from typing import Any, Dict, Optional
+
+import orjson
+
+# dikompilasi sekali di level modul (dipakai tiap parse balasan LLM)
+_FENCE_RE = re.compile(r"^```(json)?|```$", re.I)
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.S)
 
 
 class BaseAgent(ABC):
@@ -11,6 +18,23 @@ class BaseAgent(ABC):
         self.name = name
         self.role = role
 
+    def _safe_json_load(self, text: str) -> Optional[Dict[str, Any]]:
+        """
+        Best-effort parse JSON dari balasan LLM (buang ```json fence, ambil {...} terluar).
+        Return None kalau tidak ada JSON valid.
+        """
+        text = _FENCE_RE.sub("", (text or "").strip()).strip()
+        try:
+            return orjson.loads(text)
+        except Exception:
+            m = _JSON_OBJ_RE.search(text)
+            if not m:
+                return None
+            try:
+                return orjson.loads(m.group())
+            except Exception:
+                return None
+
     @abstractmethod
     def run(self, task: str, context: Dict[str, Any]) -> Dict[str, Any]:
         """
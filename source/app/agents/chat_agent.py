@@ -1,21 +1,82 @@
 from __future__ import annotations
 
-import json
+import asyncio
 import re
-from dataclasses import dataclass, asdict
-from typing import Any, Dict, List, Optional, Literal
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Literal, Tuple
 from datetime import datetime, date
 
+import numpy as np
+import orjson
+import pandas as pd
+
 from .base_agent import BaseAgent
-from .sql_agent import SQLAgent
+from .sql_agent import SQLAgent, get_sql_agent
 from .rag_agent import RAGAgent
 from .orchestrator import OrchestratorAgent
-from app.core.llm import chat_completion
+from .intent_setfit import predict_intent
+from app.core.llm import cached_chat_completion, cached_chat_completion_stream
+
+HYBRID_POOL_WORKERS = 16
 
 Intent = Literal["sql", "rag", "analytics", "hybrid", "general"]
 Lang = Literal["id", "en"]
 
 
+# orjson: numpy scalar/array, datetime dan NaN/inf (-> null) ditangani native.
+_ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+_INF = (float("inf"), float("-inf"))
+
+# Fast-path router untuk pesan yang jelas intent-nya (tanpa LLM).
+# Greeting harus seluruh pesan; sql/analytics hanya kalau tidak ambigu.
+_GREETING_RE = re.compile(
+    r"^\s*(hi|hello|hey|halo|hai|thanks|thank you|makasih|terima kasih)( (ya|yah|banyak|kak|bro))?\s*[!.?]*\s*$",
+    re.I,
+)
+_SQL_RE = re.compile(r"\b(total|sum|average|avg|count|group by|top \d+|berapa|jumlah|rata-rata)\b", re.I)
+_ANALYTICS_RE = re.compile(r"\b(analy[sz]e|analisis|eda|insights?|overview|rangkum)\b", re.I)
+# kata yang butuh penjelasan/konteks -> biarkan router LLM memilih rag/hybrid
+_EXPLAIN_RE = re.compile(r"\b(why|kenapa|mengapa|explain|jelaskan|recommend\w*|rekomendasi|saran)\b", re.I)
+
+
+def _fast_route(message: str) -> Optional[Intent]:
+    if _GREETING_RE.match(message):
+        return "general"
+    if _EXPLAIN_RE.search(message):
+        return None
+    is_sql = _SQL_RE.search(message) is not None
+    is_analytics = _ANALYTICS_RE.search(message) is not None
+    if is_sql and not is_analytics:
+        return "sql"
+    if is_analytics and not is_sql:
+        return "analytics"
+    return None
+
+
+def _clean_values(s: pd.Series) -> List[Any]:
+    """Satu kolom -> list Python: datetime -> ISO string, NaN/inf/NA/NaT -> None."""
+    dtype = s.dtype
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        vals = s.dt.strftime("%Y-%m-%dT%H:%M:%S").tolist()
+        return [None if v != v else v for v in vals]  # NaT -> NaN -> None
+
+    vals = s.tolist()
+    # fast path hanya untuk numpy dtype (nullable Int64/Float64 bisa berisi pd.NA)
+    kind = dtype.kind if isinstance(dtype, np.dtype) else "O"
+    if kind in "iub":
+        return vals  # int/bool numpy tidak punya missing
+    if kind == "f":
+        a = s.to_numpy()
+        for j in np.flatnonzero(~np.isfinite(a)):
+            vals[j] = None
+        return vals
+    return [
+        None if v is None or v is pd.NA or v is pd.NaT or (type(v) is float and (v != v or v in _INF)) else v
+        for v in vals
+    ]
+
+
 @dataclass
 class ChatState:
     last_intent: Optional[Intent] = None
@@ -24,6 +85,13 @@ class ChatState:
     last_sql_preview_rows: Optional[List[Any]] = None
     last_rag_top_sources: Optional[List[Dict[str, Any]]] = None
 
+    def to_dict(self) -> Dict[str, Any]:
+        # shallow (asdict() deep-copy tiap list/dict, tidak perlu untuk serialisasi)
+        return dict(self.__dict__)
+
+    def to_json(self) -> str:
+        return orjson.dumps(self.__dict__, option=_ORJSON_OPTS, default=str).decode()
+
 
 class ChatAgent(BaseAgent):
     def __init__(
@@ -33,170 +101,84 @@ class ChatAgent(BaseAgent):
         orchestrator: Optional[OrchestratorAgent] = None,
     ):
         super().__init__(name="ChatAgent", role="Main conversational router")
-        self.sql_agent = sql_agent or SQLAgent()
+        self._shared_sql_agent = sql_agent is None
+        self.sql_agent = sql_agent or get_sql_agent()
         self.rag_agent = rag_agent or RAGAgent()
         self.orchestrator = orchestrator or OrchestratorAgent()
+        # hybrid: RAG jalan di sini, SQL tetap di thread pemanggil -> 1 thread per turn.
+        # Ukuran ~ jumlah request hybrid bersamaan per worker, supaya tidak antre.
+        self._pool = ThreadPoolExecutor(max_workers=HYBRID_POOL_WORKERS, thread_name_prefix="chat-rag")
 
     # -----------------------------
     # Helpers
     # -----------------------------
-    def _safe_json_load(self, text: str) -> Optional[Dict[str, Any]]:
-        text = re.sub(r"^```(json)?|```$", "", text.strip(), flags=re.I)
-        try:
-            return json.loads(text)
-        except Exception:
-            m = re.search(r"\{.*\}", text, flags=re.S)
-            return json.loads(m.group()) if m else None
-
     def _truncate(self, rows: List[Any], n: int = 5) -> List[Any]:
         return rows[:n]
 
     def _to_iso(self, x: Any) -> str:
-        # datetime/date
+        # Timestamp/NaT adalah subclass datetime; Timedelta/datetime64/timedelta64 cukup str()
         if isinstance(x, (datetime, date)):
             return x.isoformat()
-
-        # pandas Timestamp / Timedelta
-        try:
-            import pandas as pd  # type: ignore
-            if isinstance(x, pd.Timestamp):
-                # safe even if tz-aware
-                return x.isoformat()
-            if isinstance(x, pd.Timedelta):
-                return str(x)
-        except Exception:
-            pass
-
-        # numpy datetime64 / timedelta64
-        try:
-            import numpy as np  # type: ignore
-            if isinstance(x, np.datetime64):
-                return str(x)
-            if isinstance(x, np.timedelta64):
-                return str(x)
-        except Exception:
-            pass
-
         return str(x)
 
     def _sanitize_for_json(self, obj: Any) -> Any:
         """
-        Convert non-JSON-serializable objects (DataFrame/Series/numpy/NaN/Timestamp)
-        into JSON-friendly preview shapes.
+        Reduce DataFrame/Series into JSON-friendly preview shapes.
+        Scalars (numpy/NaN/datetime) are left as-is for orjson in _safe_payload_text.
         """
-        # optional deps
-        try:
-            import numpy as np  # type: ignore
-        except Exception:
-            np = None  # type: ignore
-
-        try:
-            import pandas as pd  # type: ignore
-        except Exception:
-            pd = None  # type: ignore
-
-        if obj is None:
-            return None
-
-        # datetime-like early
-        if isinstance(obj, (datetime, date)):
-            return obj.isoformat()
-
-        if pd is not None:
-            if isinstance(obj, pd.Timestamp):
-                return obj.isoformat()
-            if isinstance(obj, pd.Timedelta):
-                return str(obj)
-
-        if np is not None:
-            if isinstance(obj, np.datetime64):
-                return str(obj)
-            if isinstance(obj, np.timedelta64):
-                return str(obj)
-
-        # numpy scalars
-        if np is not None:
-            if isinstance(obj, (np.integer,)):
-                return int(obj)
-            if isinstance(obj, (np.bool_,)):
-                return bool(obj)
-            if isinstance(obj, (np.floating,)):
-                x = float(obj)
-                if x != x or x in (float("inf"), float("-inf")):
-                    return None
-                return x
-
-        # floats NaN/inf
-        if isinstance(obj, float):
-            if obj != obj or obj in (float("inf"), float("-inf")):
-                return None
-            return obj
-
-        # pandas DataFrame/Series
-        if pd is not None:
-            if isinstance(obj, pd.DataFrame):
-                preview = obj.head(30).copy()
-
-                # replace NaN/inf -> None
-                try:
-                    preview = preview.replace([float("inf"), float("-inf")], None)
-                    preview = preview.where(pd.notnull(preview), None)
-                except Exception:
-                    pass
-
-                # convert timestamps inside DataFrame
+        # dict/list recursion
+        if isinstance(obj, dict):
+            return {str(k): self._sanitize_for_json(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            # list of records (mis. SQL rows): kalau orjson sudah bisa encode apa adanya,
+            # jangan rekursi per cell di Python
+            if obj and isinstance(obj[0], (dict, list, tuple)):
                 try:
-                    for c in preview.columns:
-                        if pd.api.types.is_datetime64_any_dtype(preview[c]):
-                            preview[c] = preview[c].astype("datetime64[ns]").dt.strftime("%Y-%m-%dT%H:%M:%S")
-                except Exception:
+                    orjson.dumps(obj, option=_ORJSON_OPTS)
+                    return obj
+                except TypeError:
                     pass
+            return [self._sanitize_for_json(x) for x in obj]
 
-                return {
-                    "_type": "dataframe",
-                    "shape": [int(obj.shape[0]), int(obj.shape[1])],
-                    "columns": [str(c) for c in preview.columns.tolist()],
-                    "rows": preview.to_dict(orient="records"),
-                }
+        # pandas DataFrame/Series
+        if isinstance(obj, pd.DataFrame):
+            preview = obj.head(30)
+            cols = preview.columns.tolist()
+            # satu pass per kolom (dispatch by dtype), bukan replace + where + loop datetime
+            arrs = [_clean_values(preview.iloc[:, i]) for i in range(len(cols))]
+            rows = [dict(zip(cols, row)) for row in zip(*arrs)] if cols else [{} for _ in range(len(preview))]
+
+            return {
+                "_type": "dataframe",
+                "shape": [int(obj.shape[0]), int(obj.shape[1])],
+                "columns": [str(c) for c in cols],
+                "rows": rows,
+            }
 
-            if isinstance(obj, pd.Series):
-                s = obj.head(50)
-                try:
-                    s = s.replace([float("inf"), float("-inf")], None)
-                    s = s.where(pd.notnull(s), None)
-                except Exception:
-                    pass
+        if isinstance(obj, pd.Series):
+            return {
+                "_type": "series",
+                "name": str(getattr(obj, "name", "")),
+                "values": _clean_values(obj.head(50)),
+            }
 
-                # convert datetime series
-                try:
-                    if pd.api.types.is_datetime64_any_dtype(s):
-                        s = s.dt.strftime("%Y-%m-%dT%H:%M:%S")
-                except Exception:
-                    pass
+        # orjson menolak np.datetime64("NaT") (tidak lewat default=), jadi stringify di sini
+        if isinstance(obj, np.datetime64):
+            return str(obj)
 
-                return {
-                    "_type": "series",
-                    "name": str(getattr(obj, "name", "")),
-                    "values": s.tolist(),
-                }
+        return obj
 
-        # dict/list recursion
-        if isinstance(obj, dict):
-            return {str(k): self._sanitize_for_json(v) for k, v in obj.items()}
-        if isinstance(obj, (list, tuple)):
-            return [self._sanitize_for_json(x) for x in obj]
-
-        # last resort: try json, else string
+    def _safe_payload_text(self, payload: Dict[str, Any]) -> str:
+        # EAFP: payload general/sql/rag biasanya sudah JSON-native -> satu panggilan C.
+        # Tanpa default=, DataFrame/Series/Timestamp/key non-str raise TypeError -> baru sanitize.
         try:
-            json.dumps(obj)
-            return obj
-        except Exception:
-            return self._to_iso(obj)
+            return orjson.dumps(payload, option=_ORJSON_OPTS).decode()
+        except TypeError:
+            pass
 
-    def _safe_payload_text(self, payload: Dict[str, Any]) -> str:
         safe = self._sanitize_for_json(payload)
-        # default=str is an extra safety net for weird objects
-        return json.dumps(safe, ensure_ascii=False, default=str)
+        # default=_to_iso: pd.Timestamp/NaT/Timedelta dan objek aneh lain -> string
+        return orjson.dumps(safe, option=_ORJSON_OPTS, default=self._to_iso).decode()
 
     # -----------------------------
     # Intent router
@@ -208,8 +190,23 @@ class ChatAgent(BaseAgent):
         state: Optional[ChatState],
         answer_lang: Lang,
     ) -> Dict[str, Any]:
-        hist = "\n".join(f'{m["role"]}: {m["content"]}' for m in history[-6:]) or "(empty)"
-        state_txt = json.dumps(asdict(state), ensure_ascii=False, default=str) if state else "{}"
+        fast = _fast_route(user_message)
+        if fast is not None:
+            return {"intent": fast, "reason": "fast-path", "need_followup": False, "followup_question": ""}
+
+        # classifier lokal dulu; LLM hanya kalau model tidak ada / confidence rendah
+        pred = predict_intent(user_message)
+        if pred is not None:
+            intent, conf = pred
+            return {
+                "intent": intent,
+                "reason": f"SetFit classifier (p={conf:.2f})",
+                "need_followup": False,
+                "followup_question": "",
+            }
+
+        hist = "\n".join([f'{m["role"]}: {m["content"]}' for m in history[-6:]]) or "(empty)"
+        state_txt = state.to_json() if state else "{}"
 
         system = (
             "You are an intent router for a multi-agent analytics chatbot.\n"
@@ -229,7 +226,7 @@ class ChatAgent(BaseAgent):
             "Return JSON with keys: intent, reason, need_followup, followup_question."
         )
 
-        raw = chat_completion(system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=220)
+        raw = cached_chat_completion(system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=220)
         parsed = self._safe_json_load(raw)
 
         if not parsed:
@@ -249,7 +246,7 @@ class ChatAgent(BaseAgent):
     # -----------------------------
     # Final answer composer
     # -----------------------------
-    def _compose_answer(self, question: str, payload: Dict[str, Any], lang: Lang) -> str:
+    def _compose_prompt(self, question: str, payload: Dict[str, Any], lang: Lang) -> Tuple[str, str]:
         if lang == "en":
             system = (
                 "You are a senior data assistant.\n"
@@ -273,22 +270,28 @@ class ChatAgent(BaseAgent):
             f"Tool outputs (sanitized JSON preview):\n{safe_payload}\n\n"
             "Write the final answer."
         )
-        return chat_completion(system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=900)
+        return system, user
+
+    def _compose_answer(self, question: str, payload: Dict[str, Any], lang: Lang) -> str:
+        system, user = self._compose_prompt(question, payload, lang)
+        return cached_chat_completion(system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=900)
+
+    def _compose_answer_stream(self, question: str, payload: Dict[str, Any], lang: Lang) -> Iterator[str]:
+        system, user = self._compose_prompt(question, payload, lang)
+        return cached_chat_completion_stream(
+            system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=900
+        )
 
     # -----------------------------
     # Main chat
     # -----------------------------
-    def chat(
+    def _run_tools(
         self,
         user_message: str,
         history: List[Dict[str, str]],
-        answer_lang: Lang = "id",
-        state: Optional[Dict[str, Any]] = None,
-        show_debug: bool = False,
-    ) -> Dict[str, Any]:
-
-        cur_state = ChatState(**state) if isinstance(state, dict) else ChatState()
-
+        answer_lang: Lang,
+        cur_state: ChatState,
+    ) -> Tuple[Dict[str, Any], Intent, List[str], Dict[str, Any]]:
         route = self._route_intent(user_message, history, cur_state, answer_lang)
         intent: Intent = route.get("intent", "hybrid")
 
@@ -309,14 +312,26 @@ class ChatAgent(BaseAgent):
 
         elif intent == "hybrid":
             used_tools.extend(["SQLAgent", "RAGAgent"])
+            # jalan paralel: latency ~ max(sql, rag), bukan sql + rag
+            f_rag = self._pool.submit(self.rag_agent.answer, user_message)
             tool_outputs["sql"] = self.sql_agent.query(user_message, answer_lang)
-            tool_outputs["rag"] = self.rag_agent.answer(user_message)
+            tool_outputs["rag"] = f_rag.result()
 
         else:
             tool_outputs["general"] = {"note": "No tool used."}
 
-        final_answer = self._compose_answer(user_message, tool_outputs, answer_lang)
+        return route, intent, used_tools, tool_outputs
 
+    def _build_output(
+        self,
+        final_answer: str,
+        route: Dict[str, Any],
+        intent: Intent,
+        used_tools: List[str],
+        tool_outputs: Dict[str, Any],
+        cur_state: ChatState,
+        show_debug: bool,
+    ) -> Dict[str, Any]:
         # update state
         cur_state.last_intent = intent
         if isinstance(tool_outputs.get("sql"), dict):
@@ -331,7 +346,7 @@ class ChatAgent(BaseAgent):
             "final_answer": final_answer,
             "used_tools": used_tools,
             "tool_outputs": tool_outputs,
-            "state": asdict(cur_state),
+            "state": cur_state.to_dict(),
         }
 
         if show_debug:
@@ -343,6 +358,79 @@ class ChatAgent(BaseAgent):
 
         return out
 
+    def chat(
+        self,
+        user_message: str,
+        history: List[Dict[str, str]],
+        answer_lang: Lang = "id",
+        state: Optional[Dict[str, Any]] = None,
+        show_debug: bool = False,
+    ) -> Dict[str, Any]:
+
+        cur_state = ChatState(**state) if isinstance(state, dict) else ChatState()
+
+        route, intent, used_tools, tool_outputs = self._run_tools(user_message, history, answer_lang, cur_state)
+        final_answer = self._compose_answer(user_message, tool_outputs, answer_lang)
+
+        return self._build_output(final_answer, route, intent, used_tools, tool_outputs, cur_state, show_debug)
+
+    def chat_stream(
+        self,
+        user_message: str,
+        history: List[Dict[str, str]],
+        answer_lang: Lang = "id",
+        state: Optional[Dict[str, Any]] = None,
+        show_debug: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Sama seperti chat(), tapi jawaban akhir di-stream:
+        yield {"delta": "..."} per potongan teks, lalu terakhir {"done": True, "result": <output chat()>}.
+        """
+        cur_state = ChatState(**state) if isinstance(state, dict) else ChatState()
+
+        route, intent, used_tools, tool_outputs = self._run_tools(user_message, history, answer_lang, cur_state)
+
+        parts: List[str] = []
+        for piece in self._compose_answer_stream(user_message, tool_outputs, answer_lang):
+            parts.append(piece)
+            yield {"delta": piece}
+
+        out = self._build_output("".join(parts), route, intent, used_tools, tool_outputs, cur_state, show_debug)
+        yield {"done": True, "result": out}
+
+    async def achat(
+        self,
+        user_message: str,
+        history: List[Dict[str, str]],
+        answer_lang: Lang = "id",
+        state: Optional[Dict[str, Any]] = None,
+        show_debug: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Async wrapper untuk server (FastAPI): pipeline tools + LLM tetap sync,
+        jadi dijalankan di worker thread supaya event loop tidak ter-block.
+        """
+        return await asyncio.to_thread(
+            self.chat,
+            user_message=user_message,
+            history=history,
+            answer_lang=answer_lang,
+            state=state,
+            show_debug=show_debug,
+        )
+
+    def close(self) -> None:
+        """
+        Release the tool thread pool and the shared SQL connections. An injected
+        sql_agent belongs to the caller and is left open. The process-wide OpenAI
+        HTTP pool (app.core.llm) is shared by every agent and closed by the server.
+        """
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._shared_sql_agent:
+            # singleton sudah ditutup -> instance berikutnya buka koneksi baru
+            self.sql_agent.close()
+            get_sql_agent.cache_clear()
+
     # -----------------------------
     # BaseAgent abstract method
     # -----------------------------
@@ -1,10 +1,17 @@
 from __future__ import annotations
 
+import os
+from pathlib import Path
 from typing import Any, Dict
 import pandas as pd
 
 from .base_agent import BaseAgent
-from app.core.data_loader import OlistDataLoader
+from app.core.config import CACHE_DIR
+from app.core.data_loader import OlistDataLoader, get_loader
+from app.core.utils import df_to_records
+
+# naikkan kalau kolom/dtype hasil _build_merged berubah (invalidasi parquet cache lama)
+_MERGED_VERSION = 2
 
 
 class DataAgent(BaseAgent):
@@ -18,22 +25,30 @@ class DataAgent(BaseAgent):
 
     def __init__(self, loader: OlistDataLoader | None = None):
         super().__init__(name="DataAgent", role="Data loading and preprocessing")
-        self.loader = loader or OlistDataLoader()
+        self.loader = loader or get_loader()
+        self._merged: pd.DataFrame | None = None
+        self._merged_key: int | None = None
 
     @staticmethod
     def _ensure_datetime(df: pd.DataFrame, cols: list[str]) -> pd.DataFrame:
-        for c in cols:
-            if c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c]):
-                df[c] = pd.to_datetime(df[c], errors="coerce")
+        # copy hanya kalau memang ada kolom yang perlu dikonversi (input tidak dimutasi)
+        todo = [c for c in cols if c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c])]
+        if not todo:
+            return df
+        df = df.copy()
+        for c in todo:
+            df[c] = pd.to_datetime(df[c], errors="coerce")
         return df
 
-    def run(self, task: str, context: Dict[str, Any]) -> Dict[str, Any]:
-        # Load dataset utama
-        orders = self.loader.orders.copy()
-        order_items = self.loader.order_items.copy()
-        customers = self.loader.customers.copy()
-        reviews = self.loader.order_reviews.copy()
-        payments = self.loader.order_payments.copy()
+    def _build_merged(self) -> pd.DataFrame:
+        # Load dataset utama, hanya kolom yang dipakai di bawah (SELECT dipruning di loader).
+        # Tanpa .copy(): tabel loader (cached) hanya dibaca; groupby/merge membuat frame baru.
+        # loader.orders juga di-cache (shared) -> kolom baru hanya lewat .assign.
+        orders = self.loader.orders
+        order_items = self.loader.table("order_items", ["order_id", "order_item_id", "price", "freight_value"])
+        customers = self.loader.table("customers", ["customer_id", "customer_city", "customer_state"])
+        reviews = self.loader.table("order_reviews", ["order_id", "review_score"])
+        payments = self.loader.table("order_payments", ["order_id", "payment_value", "payment_sequential"])
 
         # Pastikan kolom tanggal berbentuk datetime (kalau masih string)
         orders = self._ensure_datetime(
@@ -47,9 +62,15 @@ class DataAgent(BaseAgent):
             ],
         )
 
+        # Satu CategoricalDtype untuk order_id di semua tabel: key di-hash sekali,
+        # groupby/merge berikutnya jalan di integer codes (bukan string hashing berulang).
+        order_key = pd.CategoricalDtype(orders["order_id"].unique())
+        # Tabel loader tidak dimutasi: key categorical dipakai sebagai groupby key terpisah.
+        orders = orders.assign(order_id=orders["order_id"].astype(order_key))
+
         # Agregasi order_items ke level order_id
         oi_agg = (
-            order_items.groupby("order_id")
+            order_items.groupby(order_items["order_id"].astype(order_key), observed=True, sort=False)
             .agg(
                 total_items=("order_item_id", "count"),
                 total_price=("price", "sum"),
@@ -60,7 +81,7 @@ class DataAgent(BaseAgent):
 
         # Agregasi payments ke level order_id
         pay_agg = (
-            payments.groupby("order_id")
+            payments.groupby(payments["order_id"].astype(order_key), observed=True, sort=False)
             .agg(
                 payment_value=("payment_value", "sum"),
                 n_payments=("payment_sequential", "max"),
@@ -70,18 +91,21 @@ class DataAgent(BaseAgent):
 
         # Ambil review score (1 row per order_id)
         reviews_simple = reviews[["order_id", "review_score"]].drop_duplicates()
+        reviews_simple = reviews_simple.assign(order_id=reviews_simple["order_id"].astype(order_key))
 
         df = (
             orders.merge(oi_agg, on="order_id", how="left")
             .merge(pay_agg, on="order_id", how="left")
             .merge(reviews_simple, on="order_id", how="left")
-            .merge(
-                customers[["customer_id", "customer_city", "customer_state"]],
-                on="customer_id",
-                how="left",
-            )
+            .merge(customers, on="customer_id", how="left")
         )
 
+        # Kolom low-cardinality -> category sekali di sini (ikut tersimpan di parquet cache),
+        # supaya value_counts di EDAAgent jalan di codes, bukan string object.
+        for c in ("order_status", "customer_state", "customer_city"):
+            if c in df.columns:
+                df[c] = df[c].astype("category")
+
         # Feature keterlambatan delivery
         if "order_delivered_customer_date" in df.columns and "order_estimated_delivery_date" in df.columns:
             df["delivery_delay"] = (
@@ -90,6 +114,44 @@ class DataAgent(BaseAgent):
         else:
             df["delivery_delay"] = pd.NA
 
+        return df
+
+    def _cache_path(self, key: int) -> Path:
+        return CACHE_DIR / f"orders_merged_v{_MERGED_VERSION}_{key}.parquet"
+
+    def _load_merged(self) -> pd.DataFrame:
+        """
+        Merged orders deterministik selama DB tidak berubah: memo in-process,
+        lalu parquet di CACHE_DIR (key = mtime DB), baru rebuild kalau dua-duanya miss.
+        """
+        key = self.loader.db_path.stat().st_mtime_ns
+        if self._merged is not None and self._merged_key == key:
+            return self._merged
+
+        path = self._cache_path(key)
+        df = None
+        if path.exists():
+            try:
+                df = pd.read_parquet(path, engine="pyarrow", memory_map=True)
+            except Exception:
+                df = None
+
+        if df is None:
+            df = self._build_merged()
+            try:
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(f".{os.getpid()}.tmp")
+                df.to_parquet(tmp, engine="pyarrow", compression="zstd", index=False)
+                tmp.replace(path)  # atomic: worker lain tidak membaca file setengah jadi
+            except Exception as e:
+                print(f"[WARN] merged parquet cache not written: {e}")
+
+        self._merged, self._merged_key = df, key
+        return df
+
+    def run(self, task: str, context: Dict[str, Any]) -> Dict[str, Any]:
+        df = self._load_merged()
+
         # ====== Context handling (FIX UTAMA) ======
         # Private DF untuk chaining (EDAAgent butuh DF):
         result_context = context.copy()
@@ -97,7 +159,7 @@ class DataAgent(BaseAgent):
 
         # Public/serializable preview untuk debug/UI/API:
         preview = df.head(20)
-        result_context["orders_merged_preview"] = preview.to_dict(orient="records")
+        result_context["orders_merged_preview"] = df_to_records(preview)
         result_context["orders_merged_columns"] = list(df.columns)
         result_context["orders_merged_shape"] = [int(df.shape[0]), int(df.shape[1])]
 
@@ -1,7 +1,7 @@
 import pandas as pd
 from typing import Dict, Any
 from .base_agent import BaseAgent
-from app.core.data_loader import OlistDataLoader
+from app.core.data_loader import OlistDataLoader, get_loader
 
 
 class DataLoaderAgent(BaseAgent):
@@ -13,9 +13,9 @@ class DataLoaderAgent(BaseAgent):
 
     def __init__(self, loader: OlistDataLoader | None = None):
         super().__init__(name="DataLoaderAgent", role="Load Olist raw tables")
-        self.loader = loader or OlistDataLoader()
+        self.loader = loader or get_loader()
 
-    def run(self, task: str, context: Dict[str, Any]) -> Dict[str, Any]:
+    def run(self, task: str, context: Dict[str, Any], build_wide: bool = False) -> Dict[str, Any]:
         customers = self.loader.customers
         orders = self.loader.orders
         order_items = self.loader.order_items
@@ -37,21 +37,27 @@ class DataLoaderAgent(BaseAgent):
             }
         )
 
-        # Optional: build wide merged table (bisa besar dan duplikatif)
-        orders_merged = (
-            orders
-            .merge(customers, on="customer_id", how="left")
-            .merge(order_items, on="order_id", how="left")
-            .merge(products, on="product_id", how="left")
-            .merge(sellers, on="seller_id", how="left")
-            .merge(payments, on="order_id", how="left")
-            .merge(reviews, on="order_id", how="left")
-        )
-        result_context["orders_merged_raw"] = orders_merged
+        # Optional: build wide merged table (bisa besar dan duplikatif) -> hanya kalau diminta
+        build_wide = build_wide or bool(context.get("build_wide"))
+        if build_wide:
+            orders_merged = (
+                orders
+                .merge(customers, on="customer_id", how="left")
+                .merge(order_items, on="order_id", how="left")
+                .merge(products, on="product_id", how="left")
+                .merge(sellers, on="seller_id", how="left")
+                .merge(payments, on="order_id", how="left")
+                .merge(reviews, on="order_id", how="left")
+            )
+            result_context["orders_merged_raw"] = orders_merged
 
         return {
             "agent": self.name,
             "role": self.role,
-            "summary": "Loaded all Olist raw tables (plus a wide merged table).",
+            "summary": (
+                "Loaded all Olist raw tables (plus a wide merged table)."
+                if build_wide
+                else "Loaded all Olist raw tables."
+            ),
             "context": result_context,
         }
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from typing import Any, Dict, List, Tuple
+import numpy as np
 import pandas as pd
 
 from .base_agent import BaseAgent
@@ -20,44 +21,50 @@ class EDAAgent(BaseAgent):
     def __init__(self):
         super().__init__(name="EDAAgent", role="Compute compact EDA stats")
 
-    def _top_missing(self, df: pd.DataFrame, top_k: int = 10) -> List[Dict[str, Any]]:
-        miss = df.isna().mean().sort_values(ascending=False).head(top_k)
-        return [{"column": c, "missing_rate": float(v)} for c, v in miss.items() if v > 0]
-
-    def _numeric_describe_compact(self, df: pd.DataFrame, cols: List[str], top_k: int = 12) -> Dict[str, Any]:
-        cols = cols[:top_k]
-        if not cols:
-            return {"columns": [], "rows": []}
-        desc = df[cols].describe().T.reset_index().rename(columns={"index": "column"})
-        # keep only a few stats
-        keep = ["column", "count", "mean", "std", "min", "25%", "50%", "75%", "max"]
-        desc = desc[keep]
-        rows = desc.to_dict(orient="records")
-        # convert numpy types to python
-        cleaned = []
-        for r in rows:
-            cleaned.append({k: (float(v) if isinstance(v, (int, float)) else v) for k, v in r.items()})
-        return {"columns": keep, "rows": cleaned}
+    _DESCRIBE_KEYS = ["column", "count", "mean", "std", "min", "25%", "50%", "75%", "max"]
+    _CAT_CANDIDATES = ["product_category_name", "product_category_en", "seller_city", "customer_state", "order_status"]
+
+    def _numeric_stats(self, col: str, s: pd.Series) -> Dict[str, Any]:
+        # setara describe(): count/mean/std(ddof=1)/quartiles atas nilai non-NaN
+        a = s.to_numpy(dtype="float64", na_value=np.nan)
+        a = a[~np.isnan(a)]
+        n = int(a.size)
+        if n == 0:
+            nan = float("nan")
+            return {"column": col, "count": 0.0, "mean": nan, "std": nan,
+                    "min": nan, "25%": nan, "50%": nan, "75%": nan, "max": nan}
+        # satu partition untuk min/quartiles/max (percentile 0/100 == min/max)
+        mn, q25, q50, q75, mx = np.percentile(a, [0, 25, 50, 75, 100]).tolist()
+        mean = float(a.mean())
+        if n > 1:
+            d = a - mean
+            std = float(np.sqrt(np.dot(d, d) / (n - 1)))
+        else:
+            std = float("nan")
+        return {
+            "column": col,
+            "count": float(n),
+            "mean": mean,
+            "std": std,
+            "min": mn,
+            "25%": q25,
+            "50%": q50,
+            "75%": q75,
+            "max": mx,
+        }
 
     def _top_categories(self, df: pd.DataFrame, col: str, top_k: int = 10) -> Dict[str, Any]:
-        vc = df[col].astype("object").fillna("NULL").value_counts().head(top_k)
-        return {"column": col, "top": [{"value": str(k), "count": int(v)} for k, v in vc.items()]}
-
-    def _detect_time_ranges(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
-        out: List[Dict[str, Any]] = []
-        for c in df.columns:
-            if pd.api.types.is_datetime64_any_dtype(df[c]):
-                s = df[c].dropna()
-                if len(s) == 0:
-                    continue
-                out.append(
-                    {
-                        "column": c,
-                        "min": s.min().isoformat(),
-                        "max": s.max().isoformat(),
-                    }
-                )
-        return out
+        # value_counts langsung (tanpa astype(object) copy); untuk kolom category
+        # ini jadi count di integer codes. Kategori dengan count 0 dibuang.
+        vc = df[col].value_counts(dropna=False).head(top_k)
+        return {
+            "column": col,
+            "top": [
+                {"value": "NULL" if pd.isna(k) else str(k), "count": int(v)}
+                for k, v in vc.items()
+                if v > 0
+            ],
+        }
 
     def run(self, task: str, context: Dict[str, Any]) -> Dict[str, Any]:
         if "orders_merged" not in context:
@@ -69,24 +76,43 @@ class EDAAgent(BaseAgent):
         shape = [int(df.shape[0]), int(df.shape[1])]
         cols = [str(c) for c in df.columns]
 
-        # Datetime coercion (if any object columns look like timestamps, skip heavy parsing)
-        # We rely on DataAgent for proper typing; this just safely detects.
-        time_ranges = self._detect_time_ranges(df)
-
-        # Missingness
-        missing_top = self._top_missing(df, top_k=10)
+        # Satu loop kolom: klasifikasi dtype sekali, hitung stat yang relevan inline
+        # (bukan 4 scan terpisah: time range, isna().mean(), describe(), value_counts).
+        time_ranges: List[Dict[str, Any]] = []
+        missing: List[Tuple[str, float]] = []
+        numeric_rows: List[Dict[str, Any]] = []
+        cat_cols = [c for c in self._CAT_CANDIDATES if c in df.columns][:4]
+        cat_by_col: Dict[str, Dict[str, Any]] = {}
 
-        # Numeric columns
-        num_cols = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
-        numeric_desc = self._numeric_describe_compact(df, num_cols, top_k=12)
-
-        # Category columns (choose a few common ones if exist)
-        cat_candidates = []
-        for candidate in ["product_category_name", "product_category_en", "seller_city", "customer_state", "order_status"]:
-            if candidate in df.columns:
-                cat_candidates.append(candidate)
-        cat_candidates = cat_candidates[:4]
-        category_summaries = [self._top_categories(df, c, top_k=10) for c in cat_candidates]
+        for c in df.columns:
+            s = df[c]
+            rate = float(s.isna().mean()) if len(s) else 0.0
+            if rate > 0:
+                missing.append((c, rate))
+
+            if pd.api.types.is_datetime64_any_dtype(s.dtype):
+                if rate < 1.0 and len(s):
+                    time_ranges.append({"column": c, "min": s.min().isoformat(), "max": s.max().isoformat()})
+            elif pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+                # Numeric columns (compact: 12 kolom pertama)
+                if len(numeric_rows) < 12:
+                    numeric_rows.append(self._numeric_stats(c, s))
+
+            if c in cat_cols:
+                cat_by_col[c] = self._top_categories(df, c, top_k=10)
+
+        # Missingness (top 10)
+        missing.sort(key=lambda kv: kv[1], reverse=True)
+        missing_top = [{"column": c, "missing_rate": v} for c, v in missing[:10]]
+
+        numeric_desc = (
+            {"columns": list(self._DESCRIBE_KEYS), "rows": numeric_rows}
+            if numeric_rows
+            else {"columns": [], "rows": []}
+        )
+
+        # Category columns (urutan kandidat dipertahankan)
+        category_summaries = [cat_by_col[c] for c in cat_cols]
 
         eda = {
             "shape": shape,
@@ -3,7 +3,7 @@ from __future__ import annotations
 from typing import Any, Dict, List
 
 from .base_agent import BaseAgent
-from app.core.llm import chat_completion
+from app.core.llm import cached_chat_completion
 
 
 class InsightAgent(BaseAgent):
@@ -48,21 +48,15 @@ class InsightAgent(BaseAgent):
             "}\n"
         )
 
-        raw = chat_completion(system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=900)
+        # EDA deterministik dari data yang sama -> prompt identik -> hit cache LRU
+        raw = cached_chat_completion(system_prompt=system, messages=[{"role": "user", "content": user}], max_tokens=900)
 
         # best-effort parse JSON
-        import json, re
-        txt = raw.strip()
-        txt = re.sub(r"^```(json)?|```$", "", txt, flags=re.I).strip()
-        try:
-            analytics = json.loads(txt)
-        except Exception:
-            m = re.search(r"\{.*\}", txt, flags=re.S)
-            analytics = json.loads(m.group()) if m else {
-                "headline": "Analytics summary",
-                "insights": [],
-                "next_questions": [],
-            }
+        analytics = self._safe_json_load(raw) or {
+            "headline": "Analytics summary",
+            "insights": [],
+            "next_questions": [],
+        }
 
         # hard guard: ensure exactly 5 insights (pad/truncate)
         insights = analytics.get("insights") or []
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import json
+import re
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+from app.core.config import INTENT_MODEL_PATH
+
+# setfit (+ torch) opsional dan baru di-import di _get_model() kalau INTENT_MODEL_PATH
+# di-set (worker tanpa model tidak ikut memuat torch). Tidak ter-install / path kosong ->
+# router otomatis pakai LLM seperti biasa. Model dilatih dengan app/train_intent_setfit.py.
+
+INTENT_LABELS = ("sql", "rag", "analytics", "hybrid", "general")
+MIN_CONFIDENCE = 0.7
+# urutan label (= kolom predict_proba), ditulis train_intent_setfit.py di samping model
+LABELS_FILE = "intent_labels.json"
+
+_model: Any = None
+_labels: List[str] = []
+_model_failed = False
+_model_lock = threading.Lock()
+
+_WS_RE = re.compile(r"\s+")
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+
+def _load_labels(model_path: str) -> List[str]:
+    """Label mapping wajib ada dan harus persis set INTENT_LABELS; selain itu model ditolak."""
+    labels = json.loads((Path(model_path) / LABELS_FILE).read_text(encoding="utf-8"))
+    if sorted(labels) != sorted(INTENT_LABELS):
+        raise ValueError(f"{LABELS_FILE} labels {labels} != {list(INTENT_LABELS)}")
+    return labels
+
+
+def _get_model() -> Any:
+    global _model, _labels, _model_failed
+    if _model is not None or _model_failed:
+        return _model
+    with _model_lock:
+        if _model is None and not _model_failed:
+            if not INTENT_MODEL_PATH:
+                _model_failed = True
+            else:
+                try:
+                    from setfit import SetFitModel  # type: ignore
+
+                    _labels = _load_labels(INTENT_MODEL_PATH)
+                    _model = SetFitModel.from_pretrained(INTENT_MODEL_PATH)
+                except Exception as e:
+                    print(f"[WARN] SetFit intent model not loaded ({e}); using LLM router.")
+                    _model_failed = True
+    return _model
+
+
+def canonical_message(text: str) -> str:
+    """Lowercase, buang tanda baca & spasi ganda -> key cache untuk parafrase ringan."""
+    return _WS_RE.sub(" ", _PUNCT_RE.sub(" ", text.lower())).strip()
+
+
+@lru_cache(maxsize=1024)
+def _predict_canonical(text: str) -> Optional[Tuple[str, float]]:
+    model = _get_model()
+    if model is None:
+        return None
+
+    probs = model.predict_proba([text])[0]
+    probs = probs.tolist() if hasattr(probs, "tolist") else list(probs)
+    if len(probs) != len(_labels):
+        return None  # head tidak cocok dengan label mapping -> jangan tebak urutan
+
+    best = max(range(len(probs)), key=probs.__getitem__)
+    return _labels[best], float(probs[best])
+
+
+def predict_intent(user_message: str) -> Optional[Tuple[str, float]]:
+    """
+    Return (intent, confidence) dari classifier SetFit kalau confidence > MIN_CONFIDENCE,
+    selain itu None (caller fallback ke LLM router).
+    """
+    text = canonical_message(user_message or "")
+    if not text:
+        return None
+
+    try:
+        pred = _predict_canonical(text)
+    except Exception:
+        return None
+
+    if pred is None:
+        return None
+    intent, conf = pred
+    if intent not in INTENT_LABELS or conf <= MIN_CONFIDENCE:
+        return None
+    return intent, conf
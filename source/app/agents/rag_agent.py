@@ -1,34 +1,146 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional
 
 import os
 import pandas as pd
-from dotenv import load_dotenv
 from openai import OpenAI
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, models
 
 from .base_agent import BaseAgent
-from app.core.llm import chat_completion
-from app.core.config import RAG_PRODUCTS_PATH, EMBEDDING_MODEL
-
-
-# ---- ENV LOADING (robust, Docker-safe) ----
-# Prefer .env at project root. If your config already loads it, this is harmless.
-def _load_env_once() -> None:
-    # /final_project/app/agents/rag_agent.py -> parents[2] == project root (/final_project)
-    project_root = Path(__file__).resolve().parents[2]
-    env_path = project_root / ".env"
-    if env_path.exists():
-        load_dotenv(env_path)
-    else:
-        # fallback: try current working dir .env (dev convenience)
-        load_dotenv()
+from app.core.llm import cached_chat_completion, cached_chat_completion_stream, http_client
+from app.core.utils import df_to_records
+from app.core.config import (
+    CACHE_DIR,
+    EMBEDDING_MODEL,
+    QDRANT_OVERSAMPLING,
+    QDRANT_POOL_SIZE,
+    QDRANT_PREFER_GRPC,
+    RAG_PRODUCTS_PATH,
+)
+
+
+# Rules + format output statis di system prompt (prefix identik tiap call -> prompt caching);
+# user message hanya berisi pertanyaan + kandidat.
+_RAG_SYSTEM_PROMPT = (
+    "You are an e-commerce product analyst.\n"
+    "You receive candidate products with metadata.\n"
+    "IMPORTANT RULES:\n"
+    "- The dataset does NOT contain product names.\n"
+    "- NEVER invent product names.\n"
+    "- Use the provided label (category + seller city) instead.\n"
+    "- Be clear and honest about what the product represents.\n\n"
+    "Jawaban harus menggunakan bahasa yang sama dengan pertanyaan user.\n\n"
+    "Format output:\n"
+    "1) Paragraf rekomendasi singkat.\n"
+    "2) Bullet list produk dengan format:\n"
+    "- Produk: <label>, Rating: <avg_review_score>, Product ID: <product_id>\n"
+    "3) Jangan menyebutkan bahwa data tidak punya nama produk kecuali ditanya."
+)
+
+_RECORD_COLUMNS = [
+    "doc_text",
+    "product_id",
+    "product_category_en",
+    "seller_id",
+    "seller_city",
+    "avg_review_score",
+    "product_label",
+]
+
+
+# LRU in-memory untuk query terbaru (retry/autocomplete) di depan cache SQLite
+_MEM_EMBED_CACHE_SIZE = 256
+# batas baris cache SQLite (LRU by atime); float32 1536 dim ~6 KB/baris -> ~30 MB.
+# Di Cloud Run filesystem writable = memori, jadi cache disk wajib dibatasi.
+_DISK_EMBED_CACHE_SIZE = 5000
+
+
+def _product_label(category: Any, city: Any) -> str:
+    # label human-readable (dataset tidak punya nama produk)
+    return f"{category or 'Unknown category'} product (seller in {city or 'Unknown city'})"
+
+
+class _EmbeddingCache:
+    """
+    Cache embedding persisten (SQLite di CACHE_DIR), key = sha256(model + text).
+    SQLite (bukan shelve/dbm) supaya aman dibuka beberapa worker gunicorn sekaligus.
+    LRU: atime di-update saat hit, baris terlama dibuang setelah put kalau lebih dari
+    max_rows. Vektor disimpan float32 (embedding OpenAI memang float32).
+    Kalau file tidak bisa dibuat (mis. filesystem read-only), cache otomatis nonaktif.
+    """
 
+    def __init__(self, path: Path, max_rows: int = _DISK_EMBED_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._max_rows = max_rows
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(path), timeout=5, check_same_thread=False)
+            # tabel lama (float64, tanpa atime, tidak pernah evict) dibuang
+            conn.execute("DROP TABLE IF EXISTS embeddings")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings_f32 "
+                "(key TEXT PRIMARY KEY, vec BLOB NOT NULL, atime REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_f32_atime ON embeddings_f32 (atime)")
+            conn.commit()
+            self._conn = conn
+        except Exception as e:
+            print(f"[WARN] embedding cache disabled: {e}")
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        if self._conn is None or not keys:
+            return {}
+        marks = ",".join("?" * len(keys))
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embeddings_f32 WHERE key IN ({marks})", keys
+                ).fetchall()
+                if rows:
+                    hit = [k for k, _ in rows]
+                    hit_marks = ",".join("?" * len(hit))
+                    self._conn.execute(
+                        f"UPDATE embeddings_f32 SET atime = ? WHERE key IN ({hit_marks})",
+                        [time.time(), *hit],
+                    )
+                    self._conn.commit()
+        except Exception:
+            return {}
+        return {k: array("f", v).tolist() for k, v in rows}
 
-_load_env_once()
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        if self._conn is None or not items:
+            return
+        try:
+            with self._lock:
+                now = time.time()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings_f32 (key, vec, atime) VALUES (?, ?, ?)",
+                    [(k, array("f", v).tobytes(), now) for k, v in items.items()],
+                )
+                self._conn.execute(
+                    "DELETE FROM embeddings_f32 WHERE key NOT IN "
+                    "(SELECT key FROM embeddings_f32 ORDER BY atime DESC LIMIT ?)",
+                    (self._max_rows,),
+                )
+                self._conn.commit()
+        except Exception as e:
+            print(f"[WARN] embedding cache write failed: {e}")
 
 
 @dataclass
@@ -60,17 +172,47 @@ class RAGAgent(BaseAgent):
         api_key = (os.getenv("OPENAI_API_KEY") or "").strip()
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY tidak ditemukan. Pastikan sudah di-set via .env atau environment variable.")
-        self._embed_client = OpenAI(api_key=api_key)
+        # reuse the process-wide keep-alive pool from app.core.llm
+        self._embed_client = OpenAI(api_key=api_key, http_client=http_client)
         self._embed_model = os.getenv("EMBEDDING_MODEL", EMBEDDING_MODEL)
+        self._embed_cache = _EmbeddingCache(CACHE_DIR / "embeddings.sqlite")
+        self._mem_embed_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._mem_embed_lock = threading.Lock()
 
         # ---- Qdrant Client ----
         qdrant_url = (os.getenv("QDRANT_URL") or "").strip()
         qdrant_api_key = (os.getenv("QDRANT_API_KEY") or "").strip()
         if not qdrant_url or not qdrant_api_key:
             raise RuntimeError("QDRANT_URL / QDRANT_API_KEY belum di-set. Pastikan ada di .env atau environment variable.")
-        self.qdrant = QdrantClient(url=qdrant_url, api_key=qdrant_api_key)
+        # pool_size: koneksi dipakai bersama oleh worker thread FastAPI (hybrid SQL+RAG paralel)
+        self.qdrant = QdrantClient(
+            url=qdrant_url,
+            api_key=qdrant_api_key,
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            pool_size=QDRANT_POOL_SIZE,
+        )
+        # Query di vektor quantized (HNSW di RAM), lalu top (limit * oversampling) di-rescore
+        # pakai vektor asli. Diabaikan Qdrant kalau collection tidak di-quantize.
+        self._search_params = (
+            models.SearchParams(
+                quantization=models.QuantizationSearchParams(
+                    ignore=False, rescore=True, oversampling=QDRANT_OVERSAMPLING
+                )
+            )
+            if QDRANT_OVERSAMPLING > 0
+            else None
+        )
+
+        # ---- rag_products.csv: hanya fallback ----
+        # doc_text + metadata dibaca dari payload Qdrant (satu RTT dengan vector query).
+        # CSV baru di-load (lazy) kalau ada hit yang payload-nya belum berisi doc_text
+        # (collection lama yang di-index tanpa payload lengkap).
+        self._rag_path = self._find_products_csv()
+        self._records: Optional[Dict[str, Dict[str, Any]]] = None
+        self._records_lock = threading.Lock()
 
-        # ---- Load rag_products.csv (DO NOT hardcode app/agents/...) ----
+    @staticmethod
+    def _find_products_csv() -> Optional[Path]:
         # Priority:
         # 1) RAG_PRODUCTS_PATH from config (recommended: data/processed/rag_products.csv)
         # 2) common fallbacks (in case you still keep a copy somewhere)
@@ -92,33 +234,96 @@ class RAGAgent(BaseAgent):
             ]
         )
 
-        rag_path: Path | None = None
         for p in candidates:
             if p and p.exists():
-                rag_path = p
-                break
-
-        if rag_path is None:
-            tried = "\n".join([str(p) for p in candidates if p is not None])
-            raise FileNotFoundError(
-                "rag_products.csv tidak ditemukan. Lokasi yang dicoba:\n"
-                f"{tried}\n\n"
-                "Solusi: simpan file di data/processed/rag_products.csv dan pastikan ter-copy ke Docker image."
-            )
-
-        self._df = pd.read_csv(rag_path)
-
-        if "doc_id" not in self._df.columns:
-            raise ValueError("rag_products.csv harus punya kolom 'doc_id'")
+                return p
+        return None
+
+    def _csv_records(self) -> Dict[str, Dict[str, Any]]:
+        """dict doc_id -> record dari rag_products.csv (load sekali, kosong kalau file tidak ada)."""
+        if self._records is not None:
+            return self._records
+        with self._records_lock:
+            if self._records is None:
+                records: Dict[str, Dict[str, Any]] = {}
+                if self._rag_path is None:
+                    print("[WARN] rag_products.csv not found; using Qdrant payload only.")
+                else:
+                    df = self._read_products(self._rag_path)
+                    if "doc_id" not in df.columns:
+                        raise ValueError("rag_products.csv harus punya kolom 'doc_id'")
+                    cols = [c for c in _RECORD_COLUMNS if c in df.columns]
+                    records = dict(zip(df["doc_id"].astype(str).tolist(), df_to_records(df[cols])))
+                self._records = records
+        return self._records
+
+    @staticmethod
+    def _read_products(path: Path) -> pd.DataFrame:
+        # hanya kolom yang dipakai (doc_id + _RECORD_COLUMNS); kategori/kota low-cardinality
+        # -> category. float/str dibiarkan default supaya nilai record tidak berubah.
+        header = pd.read_csv(path, nrows=0).columns
+        usecols = [c for c in ["doc_id", *_RECORD_COLUMNS] if c in header]
+        dtype = {c: "category" for c in ("product_category_en", "seller_city") if c in usecols}
+        try:
+            return pd.read_csv(path, usecols=usecols, dtype=dtype, engine="pyarrow")
+        except Exception:
+            return pd.read_csv(path, usecols=usecols, dtype=dtype)
+
+    def enable_binary_quantization(self) -> None:
+        """
+        Aktifkan binary quantization (1-bit, always_ram) di collection yang sudah ada.
+        Sekali jalan (mis. setelah ingest); Qdrant membangun index quantized di background.
+        """
+        self.qdrant.update_collection(
+            collection_name=self.collection_name,
+            quantization_config=models.BinaryQuantization(
+                binary=models.BinaryQuantizationConfig(always_ram=True)
+            ),
+        )
 
-        self._df.set_index("doc_id", inplace=True)
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed banyak teks sekaligus: yang sudah ada di cache (memori -> SQLite) tidak
+        dikirim ulang, sisanya (unik) dalam SATU embeddings.create. Urutan output = urutan input.
+        """
+        model = self._embed_model
+        keys = [_EmbeddingCache.key(model, t) for t in texts]
+
+        found: Dict[str, List[float]] = {}
+        with self._mem_embed_lock:
+            for k in keys:
+                vec = self._mem_embed_cache.get(k)
+                if vec is not None:
+                    self._mem_embed_cache.move_to_end(k)
+                    found[k] = vec
+
+        disk_keys = [k for k in dict.fromkeys(keys) if k not in found]
+        if disk_keys:
+            found.update(self._embed_cache.get_many(disk_keys))
+
+        missing: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in missing:
+                missing[k] = t
+
+        if missing:
+            resp = self._embed_client.embeddings.create(model=model, input=list(missing.values()))
+            data = sorted(resp.data, key=lambda d: d.index)
+            fresh = {k: d.embedding for k, d in zip(missing.keys(), data)}
+            self._embed_cache.put_many(fresh)
+            found.update(fresh)
+
+        with self._mem_embed_lock:
+            for k in keys:
+                self._mem_embed_cache[k] = found[k]
+                self._mem_embed_cache.move_to_end(k)
+            while len(self._mem_embed_cache) > _MEM_EMBED_CACHE_SIZE:
+                self._mem_embed_cache.popitem(last=False)
+
+        return [found[k] for k in keys]
 
     def _embed(self, texts: List[str]) -> List[List[float]]:
-        resp = self._embed_client.embeddings.create(
-            model=self._embed_model,
-            input=texts,
-        )
-        return [d.embedding for d in resp.data]
+        return self.embed_many(texts)
 
     def search(self, query: str) -> List[Document]:
         [vec] = self._embed([query])
@@ -127,7 +332,10 @@ class RAGAgent(BaseAgent):
             collection_name=self.collection_name,
             query=vec,
             limit=self.top_k,
-            with_payload=True,
+            search_params=self._search_params,
+            # hanya field payload yang dibaca di bawah; vektor tidak ikut dikirim balik
+            with_payload=_RECORD_COLUMNS,
+            with_vectors=False,
         )
         hits = resp.points
 
@@ -135,82 +343,75 @@ class RAGAgent(BaseAgent):
         for h in hits:
             doc_id = str(h.id)
 
-            if doc_id not in self._df.index:
-                metadata = h.payload or {}
-                text = metadata.get("doc_text", "")
-            else:
-                row = self._df.loc[doc_id]
-                text = row.get("doc_text", "")
-                metadata = {
-                    "product_id": row.get("product_id", ""),
-                    "product_category_en": row.get("product_category_en", ""),
-                    "seller_id": row.get("seller_id", ""),
-                    "seller_city": row.get("seller_city", ""),
-                    "avg_review_score": float(row.get("avg_review_score", 0) or 0),
-                    "score": h.score,
-                }
+            row = h.payload or {}
+            if "doc_text" not in row:
+                row = self._csv_records().get(doc_id, row)
+
+            text = row.get("doc_text", "")
+            metadata = {
+                "product_id": row.get("product_id", ""),
+                "product_category_en": row.get("product_category_en", ""),
+                "seller_id": row.get("seller_id", ""),
+                "seller_city": row.get("seller_city", ""),
+                "avg_review_score": float(row.get("avg_review_score", 0) or 0),
+                # idealnya sudah di payload (dihitung saat ingest); kalau belum, hitung sekali di sini
+                "product_label": row.get("product_label")
+                or _product_label(row.get("product_category_en"), row.get("seller_city")),
+                "score": h.score,
+            }
 
             docs.append(Document(id=doc_id, text=text, metadata=metadata))
 
         return docs
 
-    def answer(self, query: str) -> Dict[str, Any]:
+    def answer(self, query: str, on_token: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """
+        on_token: kalau di-set, jawaban LLM di-stream dan tiap potongan teks dikirim
+        ke callback ini (mis. tulis ke UI) sambil tetap dikumpulkan jadi "answer".
+        """
         docs = self.search(query)
 
         context_lines = []
         for i, d in enumerate(docs, start=1):
             m = d.metadata or {}
 
-            # Build HUMAN-READABLE PRODUCT LABEL
-            category = m.get("product_category_en", "") or "Unknown category"
-            city = m.get("seller_city", "") or "Unknown city"
             rating = m.get("avg_review_score", 0)
 
-            product_label = f"{category} product (seller in {city})"
-
             context_lines.append(
                 f"{i}. "
-                f"label={product_label} | "
+                f"label={m.get('product_label', '')} | "
                 f"product_id={m.get('product_id', '')} | "
                 f"avg_review_score={rating}"
             )
 
         context_text = "\n".join(context_lines) if context_lines else "(no candidates found)"
 
-        system_prompt = (
-            "You are an e-commerce product analyst.\n"
-            "You receive candidate products with metadata.\n"
-            "IMPORTANT RULES:\n"
-            "- The dataset does NOT contain product names.\n"
-            "- NEVER invent product names.\n"
-            "- Use the provided label (category + seller city) instead.\n"
-            "- Be clear and honest about what the product represents."
-        )
-
         user_msg = (
-            "Jawaban harus menggunakan bahasa yang sama dengan pertanyaan user.\n\n"
             f"Pertanyaan user:\n{query}\n\n"
             "Daftar kandidat produk:\n"
-            f"{context_text}\n\n"
-            "Format output:\n"
-            "1) Paragraf rekomendasi singkat.\n"
-            "2) Bullet list produk dengan format:\n"
-            "- Produk: <label>, Rating: <avg_review_score>, Product ID: <product_id>\n"
-            "3) Jangan menyebutkan bahwa data tidak punya nama produk kecuali ditanya."
+            f"{context_text}"
         )
 
-        answer_text = chat_completion(
-            system_prompt=system_prompt,
+        llm_kwargs = dict(
+            system_prompt=_RAG_SYSTEM_PROMPT,
             messages=[{"role": "user", "content": user_msg}],
             max_tokens=600,
+            template_id="rag_recommendation",
+            fields={"query": query, "candidates": context_text},
         )
+        if on_token is None:
+            answer_text = cached_chat_completion(**llm_kwargs)
+        else:
+            parts: List[str] = []
+            for piece in cached_chat_completion_stream(**llm_kwargs):
+                parts.append(piece)
+                on_token(piece)
+            answer_text = "".join(parts)
 
         sources: List[Dict[str, Any]] = []
         for d in docs:
             m = dict(d.metadata or {})
             m["doc_id"] = d.id
-            # add explicit label for UI/debug
-            m["product_label"] = f"{m.get('product_category_en','')} product (seller in {m.get('seller_city','')})"
             sources.append(m)
 
         return {
@@ -218,6 +419,13 @@ class RAGAgent(BaseAgent):
             "sources": sources,
         }
 
+    async def asearch(self, query: str) -> List[Document]:
+        """Async wrapper: embed + Qdrant tetap client sync yang di-pool, dijalankan di worker thread."""
+        return await asyncio.to_thread(self.search, query)
+
+    async def aanswer(self, query: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.answer, query)
+
     def run(self, task: str, context: Dict[str, Any]) -> Dict[str, Any]:
         result = self.answer(task)
         new_ctx = context.copy()
@@ -1,15 +1,70 @@
 from __future__ import annotations
 
+import queue
 import re
 import sqlite3
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List
 
-from dotenv import load_dotenv
+import orjson
 
 from .base_agent import BaseAgent
-from app.core.llm import chat_completion
-from app.core.config import PROJECT_ROOT
+from app.core.llm import cached_chat_completion, chat_completion
+from app.core.config import CACHE_DIR, PROJECT_ROOT
+
+_FENCE_RE = re.compile(r"```(?:sql)?\s*|\s*```", re.IGNORECASE)
+
+
+def _strip_fences(text: str) -> str:
+    """Buang ```sql ... ``` dari balasan LLM dalam satu pass."""
+    return _FENCE_RE.sub("", text or "").strip()
+
+
+# string literal / quoted identifier ('' dan "" escape), komentar, dan isi kurung
+# terdalam (dipakai cek LIMIT top-level dan cek keyword berbahaya).
+# Literal + komentar dalam satu alternation kiri->kanan: kutip di dalam komentar bukan
+# awal string, dan `--` di dalam string bukan komentar. /* tanpa penutup = sampai akhir.
+_SQL_LITERAL_OR_COMMENT_RE = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?(?:\*/|\Z)",
+    re.DOTALL,
+)
+_SQL_PARENS_RE = re.compile(r"\([^()]*\)")
+_LIMIT_RE = re.compile(r"\blimit\b", re.IGNORECASE)
+
+
+def _strip_literals_and_comments(sql: str) -> str:
+    """Literal -> '' dan komentar -> spasi; yang tersisa hanya kode SQL."""
+    return _SQL_LITERAL_OR_COMMENT_RE.sub(
+        lambda m: " " if m.group().startswith(("--", "/*")) else "''", sql
+    )
+
+
+def _has_top_level_limit(sql: str) -> bool:
+    """LIMIT di luar subquery / literal / komentar (LIMIT di dalam kurung tidak dihitung)."""
+    s = _strip_literals_and_comments(sql)
+    prev = None
+    while prev != s:
+        prev, s = s, _SQL_PARENS_RE.sub(" ", s)
+    return _LIMIT_RE.search(s) is not None
+
+
+# Instruksi ringkasan statis (termasuk aturan bahasa) di system prompt -> prefix stabil.
+_SUMMARY_SYSTEM_PROMPTS: Dict[str, str] = {
+    "en": (
+        "You are a senior data analyst. Summarize the result of a SQLite "
+        "query in clear and concise English.\n"
+        "Write the answer in English. "
+        "If there are no rows, clearly explain that there is no matching data."
+    ),
+    "id": (
+        "Kamu adalah analis data senior. Ringkas hasil query SQLite "
+        "dalam bahasa Indonesia yang jelas dan singkat.\n"
+        "Tulis jawaban dalam bahasa Indonesia. "
+        "Jika tidak ada baris, jelaskan dengan jelas bahwa tidak ada data yang cocok."
+    ),
+}
 
 
 class SQLAgent(BaseAgent):
@@ -34,19 +89,20 @@ class SQLAgent(BaseAgent):
         # Tambah sendiri kalau perlu
     }
 
-    # kata-kata SQL berbahaya yang tidak boleh muncul
-    UNSAFE_WORDS = [
-        "update ", "delete ", "insert ", "alter ",
-        "drop ", "create ", "replace ", "truncate "
-    ]
+    # kata-kata SQL berbahaya yang tidak boleh muncul (satu regex, word boundary;
+    # fungsi string replace(...) tetap boleh, REPLACE INTO tidak)
+    UNSAFE_RE = re.compile(
+        r"\b(update|delete|insert|alter|drop|create|truncate|attach|detach|pragma|vacuum|reindex)\b"
+        r"|\breplace\b(?!\s*\()",
+        re.IGNORECASE,
+    )
+
+    # jumlah koneksi read-only di pool (dibagi semua thread; thread lain menunggu giliran)
+    POOL_SIZE = 4
 
     def __init__(self, db_path: Path | None = None, top_n: int = 20):
         super().__init__(name="SQLAgent", role="SQL over olist.db")
 
-        env_path = PROJECT_ROOT / ".env"
-        if env_path.exists():
-            load_dotenv(env_path)
-
         self.db_path = db_path or (PROJECT_ROOT / "app" / "db" / "olist.db")
         self.top_n = top_n
 
@@ -56,6 +112,16 @@ class SQLAgent(BaseAgent):
                 "Jalankan build_sqlite.py dulu."
             )
 
+        # Pool tetap POOL_SIZE koneksi read-only long-lived (schema sudah ter-parse, page
+        # cache tetap hangat). Tidak per thread: worker thread anyio datang dan pergi, jadi
+        # koneksi per thread bocor terus. Tanpa WAL: itu menulis ke file DB.
+        self._conns: List[sqlite3.Connection] = [
+            self._open_connection() for _ in range(self.POOL_SIZE)
+        ]
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for conn in self._conns:
+            self._pool.put(conn)
+
         # Muat daftar kategori sah (auto-suggest & prompt LLM)
         self._categories = self._load_categories()
 
@@ -91,6 +157,52 @@ Aturan:
 - Tambahkan LIMIT {top_n} di akhir query.
 """
 
+        # System prompt statis (instruksi + schema + kategori) dibangun sekali di sini dan
+        # SELALU jadi prefix yang sama -> kena prompt caching OpenAI; bagian per-query
+        # (pertanyaan, SQL pertama, hasil) hanya di user message.
+        self._sql_system_prompt = (
+            "You are an SQL assistant for SQLite. "
+            "Your task is to write ONE valid SELECT query for SQLite. "
+            "NEVER output UPDATE/DELETE/INSERT/ALTER/DROP/CREATE/REPLACE/TRUNCATE. "
+            "Output only the SQL, without any explanation.\n\n"
+            f"Schema:\n{self.schema_description}\n"
+            "The user's question can be in Indonesian or English. "
+            "If the user mentions a product category in Indonesian, map it to the "
+            "closest English value in product_category_name_english "
+            "(e.g., 'elektronik' -> 'electronics'). "
+            "The query must be syntactically valid for SQLite."
+        )
+        self._fallback_system_prompt = (
+            "You are an SQL assistant for SQLite. "
+            "The first SELECT query returned 0 rows. "
+            "Write ONE alternative SELECT query that is still relevant, "
+            "but with slightly looser conditions (for example, remove overly "
+            "specific category filters or use LIKE). "
+            "The query must still be read-only. Do NOT use any write operations.\n"
+            "Respond with ONLY a JSON object: "
+            '{"sql": "<the alternative SELECT query>", '
+            '"summary_if_no_fix": "<short answer for the user explaining that no matching data was found>"}.\n\n'
+            f"Schema:\n{self.schema_description}\n"
+            "The user's question may be in Indonesian or English."
+        )
+
+    def _open_connection(self) -> sqlite3.Connection:
+        # check_same_thread=False: koneksi berpindah thread lewat pool
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA mmap_size=1073741824")  # mmap dibagi antar koneksi lewat OS
+        conn.execute("PRAGMA cache_size=-16384")
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        """Pinjam satu koneksi dari pool (blocking kalau semua sedang dipakai)."""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
     # ------------------------------------------------------------------
     # 0. Public property untuk UI (auto-suggest kategori)
     # ------------------------------------------------------------------
@@ -99,22 +211,34 @@ Aturan:
         return self._categories
 
     def _load_categories(self) -> List[str]:
-        """Ambil daftar distinct product_category_name_english dari DB."""
-        conn = sqlite3.connect(self.db_path)
+        """
+        Ambil daftar distinct product_category_name_english dari DB.
+        Hasil di-cache ke CACHE_DIR (key = mtime DB) supaya konstruksi berikutnya tidak query lagi.
+        Index idx_fact_pcat (index-only scan) dibuat saat build image, bukan di sini.
+        """
+        cache_path = CACHE_DIR / f"categories_{self.db_path.stat().st_mtime_ns}.json"
         try:
-            cur = conn.cursor()
-            cur.execute(
+            return orjson.loads(cache_path.read_bytes())
+        except Exception:
+            pass
+
+        with self._connection() as conn:
+            rows = conn.execute(
                 """
                 SELECT DISTINCT product_category_name_english
                 FROM fact_order_items
                 WHERE product_category_name_english IS NOT NULL
                 ORDER BY product_category_name_english
                 """
-            )
-            rows = cur.fetchall()
-            return [r[0] for r in rows]
-        finally:
-            conn.close()
+            ).fetchall()
+        categories = [r[0] for r in rows]
+
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_path.write_bytes(orjson.dumps(categories))
+        except OSError:
+            pass
+        return categories
 
     # ------------------------------------------------------------------
     # 1. Normalisasi pertanyaan (mapping kategori Indonesia -> English)
@@ -144,78 +268,60 @@ Aturan:
     # 2. Generate SQL dari LLM (pertanyaan bisa ID/EN)
     # ------------------------------------------------------------------
     def _generate_sql(self, question: str) -> str:
-        system_prompt = (
-            "You are an SQL assistant for SQLite. "
-            "Your task is to write ONE valid SELECT query for SQLite. "
-            "NEVER output UPDATE/DELETE/INSERT/ALTER/DROP/CREATE/REPLACE/TRUNCATE. "
-            "Output only the SQL, without any explanation."
-        )
-
-        cats_text = ", ".join(self._categories[:50]) or "(no categories found)"
-
         user_msg = (
-            f"Schema:\n{self.schema_description}\n\n"
-            f"Valid product_category_name_english values (examples):\n{cats_text}\n\n"
-            "The user's question can be in Indonesian or English.\n\n"
             f"User question:\n{question}\n\n"
-            "Write ONE SELECT query that answers the question. "
-            "If the user mentions a product category in Indonesian, map it to the "
-            "closest English value in product_category_name_english "
-            "(e.g., 'elektronik' -> 'electronics'). "
-            "The query must be syntactically valid for SQLite."
+            "Write ONE SELECT query that answers the question."
         )
 
         sql = chat_completion(
-            system_prompt=system_prompt,
+            system_prompt=self._sql_system_prompt,
             messages=[{"role": "user", "content": user_msg}],
             max_tokens=400,
-        ).strip()
+        )
 
         # bersihkan formatting ```sql ... ```
-        sql = re.sub(r"```sql", "", sql, flags=re.IGNORECASE)
-        sql = sql.replace("```", "").strip()
-
-        return sql
+        return _strip_fences(sql)
 
     # ------------------------------------------------------------------
     # 3. Generate SQL fallback kalau hasil kosong
     # ------------------------------------------------------------------
-    def _generate_fallback_sql(self, question: str, first_sql: str) -> str:
+    def _generate_fallback_and_summary(
+        self, question: str, first_sql: str, answer_lang: str = "id"
+    ) -> Dict[str, str]:
         """
-        Minta LLM membuat query alternatif yang lebih longgar
-        ketika query pertama mengembalikan hasil kosong.
+        Satu panggilan LLM untuk jalur hasil kosong: query alternatif yang lebih longgar
+        + ringkasan "tidak ada data" (dipakai kalau fallback tidak bisa memperbaiki).
+        Return {"sql": "...", "summary_if_no_fix": "..."}; field yang gagal di-parse -> "".
+        Kalau model membalas SQL polos / ber-fence tanpa JSON, balasan itu dipakai sebagai
+        sql (asal lolos _is_safe_sql), seperti fallback lama.
         """
-        system_prompt = (
-            "You are an SQL assistant for SQLite. "
-            "The first SELECT query returned 0 rows. "
-            "Write ONE alternative SELECT query that is still relevant, "
-            "but with slightly looser conditions (for example, remove overly "
-            "specific category filters or use LIKE). "
-            "The query must still be read-only. Do NOT use any write operations."
-        )
-
-        cats_text = ", ".join(self._categories[:50]) or "(no categories found)"
-
+        lang = "English" if answer_lang == "en" else "Bahasa Indonesia"
         user_msg = (
-            f"Schema:\n{self.schema_description}\n\n"
-            f"Valid product_category_name_english values (examples):\n{cats_text}\n\n"
-            "The user's question may be in Indonesian or English.\n\n"
             f"User question:\n{question}\n\n"
             f"First query (returned 0 rows):\n{first_sql}\n\n"
             "Now write ONE alternative SELECT query that is safer and more relaxed, "
-            "but still trying to answer the same question."
+            "but still trying to answer the same question.\n"
+            f"Write summary_if_no_fix in {lang}."
         )
 
-        sql = chat_completion(
-            system_prompt=system_prompt,
+        raw = chat_completion(
+            system_prompt=self._fallback_system_prompt,
             messages=[{"role": "user", "content": user_msg}],
-            max_tokens=400,
-        ).strip()
-
-        sql = re.sub(r"```sql", "", sql, flags=re.IGNORECASE)
-        sql = sql.replace("```", "").strip()
+            max_tokens=600,
+        )
 
-        return sql
+        data = self._safe_json_load(raw or "")
+        if data is None:
+            plain = self._normalize_sql(_strip_fences(raw or ""))
+            if plain and self._is_safe_sql(plain):
+                print("[WARN] fallback SQL reply was not JSON; using it as plain SQL.")
+                return {"sql": plain, "summary_if_no_fix": ""}
+            print("[WARN] fallback SQL reply unparseable; relaxed retry query dropped.")
+            data = {}
+        return {
+            "sql": _strip_fences(str(data.get("sql") or "")),
+            "summary_if_no_fix": str(data.get("summary_if_no_fix") or "").strip(),
+        }
 
     # ------------------------------------------------------------------
     # 4. Normalisasi SQL (buang ; di akhir, trim spasi)
@@ -230,38 +336,30 @@ Aturan:
     # 5. Validasi keamanan SQL
     # ------------------------------------------------------------------
     def _is_safe_sql(self, sql: str) -> bool:
-        sql_lower = sql.lower()
-
-        # wajib diawali SELECT
-        if not sql_lower.startswith("select"):
-            return False
-
-        # blokir kata-kata berbahaya
-        for bad in self.UNSAFE_WORDS:
-            if bad in sql_lower:
-                return False
-
-        # blokir multi-statement
-        if ";" in sql_lower:
-            return False
-
-        return True
+        # wajib diawali SELECT, tanpa multi-statement, tanpa kata berbahaya.
+        # Dicek setelah literal & komentar dibuang: LIKE '%update%' / ';' di dalam string
+        # tetap boleh, kutip di dalam komentar tidak menyembunyikan statement berikutnya.
+        code = _strip_literals_and_comments(sql).lstrip()
+        return (
+            code.lower().startswith("select")
+            and ";" not in code
+            and self.UNSAFE_RE.search(code) is None
+        )
 
     # ------------------------------------------------------------------
     # 6. Eksekusi ke SQLite
     # ------------------------------------------------------------------
     def _run_sql(self, sql: str) -> Dict[str, Any]:
-        conn = sqlite3.connect(self.db_path)
-
-        try:
-            cur = conn.cursor()
-            cur.execute(sql)
-            rows = cur.fetchall()
+        # Tanpa LIMIT top-level: tambahkan LIMIT (top-N sort) langsung di akhir, bukan
+        # SELECT * FROM (...) yang me-rename kolom duplikat (id, id:1). Newline supaya
+        # komentar `--` di akhir query tidak menelan LIMIT. fetchmany: maksimal top_n row.
+        if not _has_top_level_limit(sql):
+            sql = f"{sql}\nLIMIT {int(self.top_n)}"
+        with self._connection() as conn:
+            cur = conn.execute(sql)
+            rows = cur.fetchmany(self.top_n)
             cols = [d[0] for d in cur.description] if cur.description else []
-        finally:
-            conn.close()
-
-        rows = rows[: self.top_n]
+            cur.close()
 
         return {"columns": cols, "rows": rows}
 
@@ -278,33 +376,22 @@ Aturan:
         """
         answer_lang: 'id' (Bahasa Indonesia) atau 'en' (English)
         """
-        if answer_lang == "en":
-            system_prompt = (
-                "You are a senior data analyst. Summarize the result of a SQLite "
-                "query in clear and concise English."
-            )
-            lang_instruction = "Write the answer in English."
-        else:
-            system_prompt = (
-                "Kamu adalah analis data senior. Ringkas hasil query SQLite "
-                "dalam bahasa Indonesia yang jelas dan singkat."
-            )
-            lang_instruction = "Tulis jawaban dalam bahasa Indonesia."
+        system_prompt = _SUMMARY_SYSTEM_PROMPTS["en" if answer_lang == "en" else "id"]
 
         preview = f"Columns: {result['columns']}\nRows: {result['rows'][:10]}"
 
         user_msg = (
             f"User question:\n{question}\n\n"
             f"SQL executed:\n{sql}\n\n"
-            f"Result (preview):\n{preview}\n\n"
-            f"{lang_instruction} "
-            "If there are no rows, clearly explain that there is no matching data."
+            f"Result (preview):\n{preview}"
         )
 
-        return chat_completion(
+        return cached_chat_completion(
             system_prompt=system_prompt,
             messages=[{"role": "user", "content": user_msg}],
             max_tokens=400,
+            template_id="sql_summary",
+            fields={"question": question, "sql": sql, "preview": preview},
         )
 
     # ------------------------------------------------------------------
@@ -317,8 +404,8 @@ Aturan:
         2) generate SQL pertama (LLM)
         3) normalisasi & validasi keamanan
         4) eksekusi ke DB
-        5) jika hasil kosong -> generate & jalankan fallback SQL
-        6) ringkas hasil dengan LLM (bahasa ID/EN)
+        5) jika hasil kosong -> generate fallback SQL + ringkasan "tidak ada data" (satu call LLM)
+        6) ringkas hasil dengan LLM (bahasa ID/EN), kecuali ringkasan dari langkah 5 sudah cukup
         """
         normalized_q = self._normalize_question_text(question)
 
@@ -335,20 +422,26 @@ Aturan:
         sql_used = sql_1
         result_used = result_1
         sql_fallback = ""
+        summary = ""
 
         # --- fallback otomatis jika hasil kosong ---
         if len(result_1["rows"]) == 0:
-            sql_raw_2 = self._generate_fallback_sql(normalized_q, sql_1)
-            sql_2 = self._normalize_sql(sql_raw_2)
+            fb = self._generate_fallback_and_summary(normalized_q, sql_1, answer_lang=answer_lang)
+            sql_2 = self._normalize_sql(fb["sql"])
 
-            if self._is_safe_sql(sql_2):
+            if sql_2 and self._is_safe_sql(sql_2):
                 result_2 = self._run_sql(sql_2)
                 sql_used = sql_2
                 result_used = result_2
                 sql_fallback = sql_2
                 used_fallback = True
 
-        summary = self._summarize(question, sql_used, result_used, answer_lang=answer_lang)
+            # fallback tetap kosong / tidak aman -> ringkasan "tidak ada data" sudah ada, tanpa call lagi
+            if len(result_used["rows"]) == 0:
+                summary = fb["summary_if_no_fix"]
+
+        if not summary:
+            summary = self._summarize(question, sql_used, result_used, answer_lang=answer_lang)
 
         return {
             "question": question,
@@ -362,6 +455,11 @@ Aturan:
             "categories": self._categories,
         }
 
+    def close(self) -> None:
+        for conn in self._conns:
+            conn.close()
+        self._conns.clear()
+
     # ------------------------------------------------------------------
     # 9. Implementasi BaseAgent.run (untuk multi-agent orchestrator)
     # ------------------------------------------------------------------
@@ -385,3 +483,13 @@ Aturan:
             "llm_summary": output["summary"],
             "context": new_ctx,
         }
+
+
+@lru_cache(maxsize=1)
+def get_sql_agent(db_path: Path | None = None, top_n: int = 20) -> SQLAgent:
+    """
+    SQLAgent per proses: koneksi read-only + daftar kategori cukup di-warmup sekali.
+    Aman dipakai bersama antar thread: pool tetap SQLAgent.POOL_SIZE (4) koneksi
+    read-only di queue.Queue; kalau keempatnya sedang dipakai, pemanggil menunggu.
+    """
+    return SQLAgent(db_path=db_path, top_n=top_n)
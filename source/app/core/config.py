@@ -1,7 +1,8 @@
 import os
 from pathlib import Path
-from dotenv import load_dotenv
+from dotenv import find_dotenv, load_dotenv
 
+# .env cukup di-load sekali di sini (saat import); agent tidak perlu load ulang.
 # app/core/config.py -> parents[2] = project root (final_project/)
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 
@@ -10,6 +11,8 @@ if ENV_PATH.exists():
     load_dotenv(ENV_PATH)
 else:
     print(f"[WARN] .env not found at: {ENV_PATH}")
+    # fallback: .env di current working dir (dev convenience)
+    load_dotenv(find_dotenv(usecwd=True))
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 if not OPENAI_API_KEY:
@@ -17,15 +20,31 @@ if not OPENAI_API_KEY:
 
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# service tier OpenAI: "auto" (default project), "priority" = latency-optimized (kalau akun mendukung)
+OPENAI_SERVICE_TIER = os.getenv("OPENAI_SERVICE_TIER", "auto").strip() or "auto"
+
+# Jumlah entri cache jawaban LLM (exact-match, in-memory per proses). 0 = nonaktif.
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+
+# Path/HF repo model SetFit untuk intent router (opsional). Kosong = selalu pakai LLM router.
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", "")
 
 QDRANT_URL = os.getenv("QDRANT_URL", "")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", "")
+# gRPC (port 6334) lebih hemat untuk query vektor; opt-in karena butuh port gRPC terbuka.
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "0").strip().lower() in ("1", "true", "yes")
+QDRANT_POOL_SIZE = int(os.getenv("QDRANT_POOL_SIZE", "64"))
+# oversampling untuk rescore di collection yang pakai (binary) quantization; 0 = search biasa.
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", "2.0"))
 
 DATA_DIR = PROJECT_ROOT / "data"
 DATA_RAW_DIR = PROJECT_ROOT / "data" / "raw"  
 DATA_PROCESSED_DIR = PROJECT_ROOT / "data" / "processed"
 DB_PATH = PROJECT_ROOT / "app" / "db" / "olist.db"
 
+# Cache turunan (mis. merged parquet). Boleh diarahkan ke /tmp di Cloud Run.
+CACHE_DIR = Path(os.getenv("CACHE_DIR", str(DATA_DIR / "cache")))
+
 # Bisa dioverride lewat env kalau mau
 RAG_PRODUCTS_PATH = Path(os.getenv("RAG_PRODUCTS_PATH", str(DATA_PROCESSED_DIR / "rag_products.csv")))
 FACT_ORDER_ITEMS_PATH = Path(os.getenv("FACT_ORDER_ITEMS_PATH", str(DATA_PROCESSED_DIR / "fact_order_items.csv")))
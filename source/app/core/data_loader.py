@@ -1,13 +1,55 @@
 from __future__ import annotations
 
 import sqlite3
+import threading
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict, Optional, Sequence, Tuple
 
 import pandas as pd
 
 from .config import DB_PATH
 
+# duckdb opsional: scan SQLite langsung ke kolom (jauh lebih cepat dari fetch
+# row-by-row DB-API). Kalau tidak ter-install / extension sqlite tidak bisa
+# di-load, otomatis fallback ke pd.read_sql_query.
+try:
+    import duckdb  # type: ignore
+except Exception:
+    duckdb = None  # type: ignore
+
+# nama logis -> nama tabel yang mungkin ada di SQLite (dicoba berurutan)
+_TABLE_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "order_payments": ("payments", "order_payments"),
+    "payments": ("payments", "order_payments"),
+    "order_reviews": ("reviews", "order_reviews"),
+    "reviews": ("reviews", "order_reviews"),
+}
+
+_ORDER_DATE_COLS = (
+    "order_purchase_timestamp",
+    "order_approved_at",
+    "order_delivered_carrier_date",
+    "order_delivered_customer_date",
+    "order_estimated_delivery_date",
+)
+
+
+def _parse_dates(raw: pd.Series) -> pd.Series:
+    """
+    ISO8601 -> datetime. Nilai yang tidak bisa di-parse jadi NaT (NULL / string kosong
+    memang kosong); selain itu dihitung dan di-log supaya analitik tanggal tidak diam-diam bias.
+    """
+    parsed = pd.to_datetime(raw, errors="coerce", format="ISO8601", cache=True)
+    bad = parsed.isna() & raw.notna() & (raw.astype(str).str.strip() != "")
+    n_bad = int(bad.sum())
+    if n_bad:
+        print(
+            f"[WARN] {raw.name}: {n_bad} non-ISO8601 value(s) coerced to NaT "
+            f"(e.g. {raw[bad].iloc[0]!r})."
+        )
+    return parsed
+
 
 class OlistDataLoader:
     """
@@ -16,23 +58,68 @@ class OlistDataLoader:
     """
     def __init__(self, db_path: Path | str = DB_PATH):
         self.db_path = Path(db_path)
-        self._cache: Dict[str, pd.DataFrame] = {}
+        self._cache: Dict[Tuple[str, Optional[Tuple[str, ...]]], pd.DataFrame] = {}
+        self._duck: Any = None
+        self._duck_failed = duckdb is None
+        self._duck_lock = threading.Lock()
 
         if not self.db_path.exists():
             raise FileNotFoundError(f"SQLite DB not found: {self.db_path}")
 
+    def _duck_conn(self) -> Any:
+        if self._duck is None and not self._duck_failed:
+            try:
+                con = duckdb.connect()
+                path = str(self.db_path).replace("'", "''")
+                con.execute(f"ATTACH '{path}' AS olist (TYPE sqlite, READ_ONLY)")
+                con.execute("USE olist")
+                self._duck = con
+            except Exception as e:
+                print(f"[WARN] DuckDB sqlite scanner unavailable ({e}); using sqlite3.")
+                self._duck_failed = True
+        return self._duck
+
     def _read_sql(self, query: str) -> pd.DataFrame:
+        with self._duck_lock:
+            con = self._duck_conn()
+            if con is not None:
+                try:
+                    return con.execute(query).df()
+                except duckdb.CatalogException:
+                    raise  # tabel/kolom tidak ada: sqlite3 juga gagal (alias berikutnya dicoba caller)
+                except duckdb.Error as e:
+                    # mis. type affinity SQLite yang tidak cocok di scanner -> query ini lewat sqlite3
+                    print(f"[WARN] DuckDB query failed ({e}); using sqlite3.")
+
         with sqlite3.connect(self.db_path) as conn:
             return pd.read_sql_query(query, conn)
 
-    def _load_table(self, table_name: str) -> pd.DataFrame:
-        if table_name in self._cache:
-            return self._cache[table_name]
+    def _load_table(self, table_name: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        cols = tuple(columns) if columns else None
+        key = (table_name, cols)
+        if key in self._cache:
+            return self._cache[key]
 
-        df = self._read_sql(f"SELECT * FROM {table_name}")
-        self._cache[table_name] = df
+        # column pruning: SELECT hanya kolom yang dipakai caller (lebih cepat + RSS kecil)
+        select = ", ".join(f'"{c}"' for c in cols) if cols else "*"
+        df = self._read_sql(f"SELECT {select} FROM {table_name}")
+        self._cache[key] = df
         return df
 
+    def table(self, name: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """
+        Load satu tabel (opsional hanya `columns`). Nama alternatif di DB
+        (payments/order_payments, reviews/order_reviews) dicoba berurutan.
+        """
+        names = _TABLE_ALIASES.get(name, (name,))
+        for i, n in enumerate(names):
+            try:
+                return self._load_table(n, columns)
+            except Exception:
+                if i == len(names) - 1:
+                    raise
+        raise KeyError(name)  # unreachable
+
     @property
     def customers(self) -> pd.DataFrame:
         return self._load_table("customers")
@@ -43,18 +130,24 @@ class OlistDataLoader:
 
     @property
     def orders(self) -> pd.DataFrame:
-        df = self._load_table("orders").copy()
-        # parse datetime columns (kalau ada)
-        date_cols = [
-            "order_purchase_timestamp",
-            "order_approved_at",
-            "order_delivered_carrier_date",
-            "order_delivered_customer_date",
-            "order_estimated_delivery_date",
-        ]
-        for c in date_cols:
-            if c in df.columns:
-                df[c] = pd.to_datetime(df[c], errors="coerce")
+        """
+        Tabel orders dengan kolom tanggal sudah di-parse (sekali, lalu di-cache).
+        Frame ini dipakai bersama: caller jangan memutasinya (pakai .assign/.copy).
+        """
+        key = ("__orders_parsed__", None)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        df = self._load_table("orders")
+        # parse datetime columns (kalau ada); kolom baru via assign -> tabel mentah tidak dimutasi
+        parsed = {
+            c: _parse_dates(df[c])
+            for c in _ORDER_DATE_COLS
+            if c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c])
+        }
+        df = df.assign(**parsed) if parsed else df
+        self._cache[key] = df
         return df
 
     @property
@@ -66,17 +159,11 @@ class OlistDataLoader:
         # di db kamu namanya "payments" atau "order_payments"?
         # build_sqlite kamu biasanya pakai "payments"
         # jadi kita coba keduanya secara aman.
-        try:
-            return self._load_table("payments")
-        except Exception:
-            return self._load_table("order_payments")
+        return self.table("order_payments")
 
     @property
     def order_reviews(self) -> pd.DataFrame:
-        try:
-            return self._load_table("reviews")
-        except Exception:
-            return self._load_table("order_reviews")
+        return self.table("order_reviews")
 
     @property
     def products(self) -> pd.DataFrame:
@@ -85,3 +172,9 @@ class OlistDataLoader:
     @property
     def sellers(self) -> pd.DataFrame:
         return self._load_table("sellers")
+
+
+@lru_cache(maxsize=1)
+def get_loader(db_path: Path | str = DB_PATH) -> OlistDataLoader:
+    """Satu OlistDataLoader per proses (cache tabel dipakai bersama semua agent)."""
+    return OlistDataLoader(Path(db_path))
@@ -1,8 +1,31 @@
-from typing import List, Dict
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
 from openai import OpenAI
-from .config import OPENAI_API_KEY, CHAT_MODEL
+from .config import OPENAI_API_KEY, CHAT_MODEL, LLM_CACHE_SIZE, OPENAI_SERVICE_TIER
+
+# Satu pool keep-alive (sync) untuk semua panggilan OpenAI di proses ini
+# (chat + embeddings, dipakai bersama semua agent), supaya TLS handshake tidak
+# diulang tiap request. Milik proses, bukan milik agent: hanya server yang menutupnya.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+
+client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+def close_http_client() -> None:
+    """
+    Tutup koneksi pooled. Hanya untuk shutdown proses (lifespan FastAPI): client ini
+    dibagi semua agent dan tidak dibuka ulang, jadi panggilan LLM setelahnya gagal.
+    """
+    http_client.close()
 
 
 def chat_completion(
@@ -11,10 +34,12 @@ def chat_completion(
     model: str = CHAT_MODEL,
     temperature: float = 0.2,
     max_tokens: int = 800,
+    service_tier: str = OPENAI_SERVICE_TIER,
 ) -> str:
     """
     Wrapper sederhana untuk panggilan chat completion.
     messages: list of {"role": "user"/"assistant", "content": "..."}
+    service_tier: "priority" untuk latency-optimized (override via env OPENAI_SERVICE_TIER).
     """
     full_messages = [{"role": "system", "content": system_prompt}] + messages
 
@@ -23,6 +48,144 @@ def chat_completion(
         messages=full_messages,
         temperature=temperature,
         max_tokens=max_tokens,
+        service_tier=service_tier,
     )
 
     return resp.choices[0].message.content
+
+
+def chat_completion_stream(
+    system_prompt: str,
+    messages: List[Dict],
+    model: str = CHAT_MODEL,
+    temperature: float = 0.2,
+    max_tokens: int = 800,
+    service_tier: str = OPENAI_SERVICE_TIER,
+) -> Iterator[str]:
+    """
+    Versi streaming chat_completion: yield potongan teks begitu token datang
+    (UI bisa mulai render di TTFT). Berhenti iterasi = request ikut dibatalkan.
+    """
+    full_messages = [{"role": "system", "content": system_prompt}] + messages
+
+    stream = client.chat.completions.create(
+        model=model,
+        messages=full_messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        service_tier=service_tier,
+        stream=True,
+    )
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+
+
+# Exact-match response cache: key = sha256(model, params, system prompt, messages),
+# atau sha256(template_id, model, params, system prompt, fields) untuk prompt template.
+# OrderedDict + lock (bukan functools.lru_cache) karena argumennya list of dict
+# (tidak hashable) dan dipanggil dari worker thread FastAPI.
+_response_cache: "OrderedDict[str, str]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def _cache_key(
+    system_prompt: str,
+    messages: List[Dict],
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    template_id: str = "",
+    fields: Optional[Dict[str, Any]] = None,
+) -> str:
+    # template: yang menentukan jawaban hanya field dinamisnya (skeleton prompt tetap),
+    # jadi cukup itu yang di-hash, bukan seluruh teks prompt yang sudah dirender.
+    body = [template_id, fields] if fields is not None else [messages]
+    raw = json.dumps(
+        [model, temperature, max_tokens, system_prompt, *body],
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cached_chat_completion(
+    system_prompt: str,
+    messages: List[Dict],
+    model: str = CHAT_MODEL,
+    temperature: float = 0.2,
+    max_tokens: int = 800,
+    *,
+    template_id: str = "",
+    fields: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Sama seperti chat_completion, tapi prompt yang identik dijawab dari cache LRU
+    tanpa round-trip ke OpenAI.
+
+    template_id + fields: untuk prompt hasil template (mis. "sql_summary",
+    "rag_recommendation"), key dibentuk dari field dinamis yang mengisi template.
+    """
+    if LLM_CACHE_SIZE <= 0:
+        return chat_completion(system_prompt, messages, model, temperature, max_tokens)
+
+    key = _cache_key(system_prompt, messages, model, temperature, max_tokens, template_id, fields)
+    hit = _cache_get(key)
+    if hit is not None:
+        return hit
+
+    out = chat_completion(system_prompt, messages, model, temperature, max_tokens)
+    if out is not None:
+        _cache_put(key, out)
+    return out
+
+
+def cached_chat_completion_stream(
+    system_prompt: str,
+    messages: List[Dict],
+    model: str = CHAT_MODEL,
+    temperature: float = 0.2,
+    max_tokens: int = 800,
+    *,
+    template_id: str = "",
+    fields: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    Streaming + cache yang sama dengan cached_chat_completion: hit -> teks utuh
+    di-yield sekali; miss -> stream dari API, lalu disimpan kalau selesai lengkap.
+    """
+    if LLM_CACHE_SIZE <= 0:
+        yield from chat_completion_stream(system_prompt, messages, model, temperature, max_tokens)
+        return
+
+    key = _cache_key(system_prompt, messages, model, temperature, max_tokens, template_id, fields)
+    hit = _cache_get(key)
+    if hit is not None:
+        yield hit
+        return
+
+    parts: List[str] = []
+    for piece in chat_completion_stream(system_prompt, messages, model, temperature, max_tokens):
+        parts.append(piece)
+        yield piece
+    _cache_put(key, "".join(parts))
+
+
+def _cache_get(key: str) -> Optional[str]:
+    with _response_cache_lock:
+        hit = _response_cache.get(key)
+        if hit is not None:
+            _response_cache.move_to_end(key)
+        return hit
+
+
+def _cache_put(key: str, out: str) -> None:
+    with _response_cache_lock:
+        _response_cache[key] = out
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > LLM_CACHE_SIZE:
+            _response_cache.popitem(last=False)
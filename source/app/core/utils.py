@@ -0,0 +1,17 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List
+
+import pandas as pd
+
+
+def df_to_records(df: pd.DataFrame) -> List[Dict[Any, Any]]:
+    """
+    Pengganti ``df.to_dict(orient="records")``: satu ``tolist()`` per kolom lalu zip
+    jadi row dict, tanpa boxing per-cell. Nilai sudah Python native (int/float/str/Timestamp).
+    """
+    cols = df.columns.tolist()
+    if not cols:
+        return [{} for _ in range(len(df))]
+    arrs = [df.iloc[:, i].tolist() for i in range(len(cols))]
+    return [dict(zip(cols, row)) for row in zip(*arrs)]
@@ -1,12 +1,31 @@
 from __future__ import annotations
 
+import gzip
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, Iterator, Optional, Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-@dataclass
+# Satu pool keep-alive per base_url. State modul bertahan antar rerun Streamlit
+# (modul hanya di-import sekali), jadi TLS handshake ke Cloud Run cukup sekali.
+# Dipakai bersama oleh frontend_streamlit dan app/streamlit_sql_agent.py.
+_SESSIONS: Dict[str, requests.Session] = {}
+
+# Retry hanya untuk gagal connect / cold start (502/503/504 di GET); POST /chat
+# tidak di-retry setelah request terkirim (urllib3 default: POST bukan idempotent).
+# raise_on_status=False: retry habis -> response terakhir (mis. 503) dikembalikan ke
+# handling status biasa, bukan RetryError.
+_RETRY = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), raise_on_status=False)
+
+# body JSON di atas ini (history panjang / state berisi preview rows) dikirim gzip
+_GZIP_MIN_BYTES = 2048
+
+
+@dataclass(frozen=True)
 class APIConfig:
     base_url: str
     timeout: int = 90
@@ -22,13 +41,24 @@ def _join(base_url: str, path: str) -> str:
     return f"{base}{p}"
 
 
+def _session(base_url: str) -> requests.Session:
+    s = _SESSIONS.get(base_url)
+    if s is None:
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=_RETRY)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        s = _SESSIONS.setdefault(base_url, s)
+    return s
+
+
 def health_check(cfg: APIConfig) -> Tuple[int, Dict[str, Any] | str]:
     """
     GET /health
     Return (status_code, json_or_text)
     """
     url = _join(cfg.base_url, "/health")
-    r = requests.get(url, timeout=30)
+    r = _session(cfg.base_url).get(url, timeout=(5, 30))
     try:
         return r.status_code, r.json()
     except Exception:
@@ -42,6 +72,7 @@ def chat(
     answer_lang: str = "id",
     show_debug: bool = False,
     state: Optional[Dict[str, Any]] = None,
+    session_id: Optional[str] = None,
 ) -> Dict[str, Any]:
     """
     POST /chat
@@ -51,20 +82,122 @@ def chat(
         "history": [...],
         "answer_lang": "id",
         "show_debug": false,
-        "state": {}
+        "state": {},
+        "session_id": null
       }
+    Kalau session_id sudah ada, backend memegang history-nya sendiri dan history
+    tidak dikirim; lihat _post_chat untuk fallback kalau session tidak dikenal.
+    """
+    r = _post_chat(cfg, "/chat", message, history, answer_lang, show_debug, state, session_id)
+    _raise_for_status(r)
+    return r.json()
+
+
+def stream_chat(
+    cfg: APIConfig,
+    message: str,
+    history: list[dict],
+    answer_lang: str = "id",
+    show_debug: bool = False,
+    state: Optional[Dict[str, Any]] = None,
+    session_id: Optional[str] = None,
+    final: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    POST /chat/stream (SSE). Yield potongan teks jawaban begitu datang
+    (langsung bisa dipakai st.write_stream). Event terakhir {"done": true, ...}
+    berisi body yang sama dengan /chat (state, session_id, debug) dan
+    disalin ke dict `final` kalau diberikan. Stream yang berhenti sebelum event done
+    (koneksi putus / server mati) -> APIError, supaya jawaban parsial tidak dianggap selesai.
+    """
+    with _post_chat(
+        cfg, "/chat/stream", message, history, answer_lang, show_debug, state, session_id, stream=True
+    ) as r:
+        _raise_for_status(r)
+
+        for line in r.iter_lines():
+            if not line.startswith(b"data:"):
+                continue  # baris kosong pemisah frame / komentar keep-alive
+            event = orjson.loads(line[5:])
+            if "delta" in event:
+                yield event["delta"]
+            elif "error" in event:
+                raise APIError(f"Stream error: {event['error']}")
+            elif event.get("done"):
+                if final is not None:
+                    final.update(event)
+                return
+
+    raise APIError("Stream ended before completion")
+
+
+def _post_chat(
+    cfg: APIConfig,
+    path: str,
+    message: str,
+    history: list[dict],
+    answer_lang: str,
+    show_debug: bool,
+    state: Optional[Dict[str, Any]],
+    session_id: Optional[str],
+    stream: bool = False,
+) -> requests.Response:
     """
-    url = _join(cfg.base_url, "/chat")
+    History di backend jadi sumber kebenaran: dengan session_id, history lokal tidak
+    dikirim. Backend balas 409 kalau session tidak dikenal (worker lain / restart /
+    instance baru) -> kirim ulang sekali dengan history lokal, tanpa session_id.
+    Dengan beberapa worker gunicorn jalur 409 ini normal (SessionStore per worker),
+    biayanya satu round trip tambahan + body berisi history yang sudah di-cap.
+    """
+    url = _join(cfg.base_url, path)
+    extra = {"Accept": "text/event-stream"} if stream else {}
+
+    def post(hist: list[dict], sid: Optional[str]) -> requests.Response:
+        body, headers = _encode_body(_chat_payload(message, hist, answer_lang, show_debug, state, sid))
+        return _session(cfg.base_url).post(
+            url,
+            data=body,
+            headers={**headers, **extra},
+            timeout=(5, cfg.timeout),
+            stream=stream,
+        )
+
+    r = post([] if session_id else history, session_id)
+    if r.status_code == 409 and session_id:
+        r.close()
+        r = post(history, None)
+    return r
+
+
+def _chat_payload(
+    message: str,
+    history: list[dict],
+    answer_lang: str,
+    show_debug: bool,
+    state: Optional[Dict[str, Any]],
+    session_id: Optional[str],
+) -> bytes:
     payload = {
         "message": message,
         "history": history or [],
         "answer_lang": answer_lang,
         "show_debug": bool(show_debug),
         "state": state or {},
+        "session_id": session_id,
     }
+    return orjson.dumps(payload)  # lebih cepat dari json= (stdlib), UTF-8 tanpa \uXXXX escape
 
-    r = requests.post(url, json=payload, timeout=cfg.timeout)
 
+def _encode_body(body: bytes) -> Tuple[bytes, Dict[str, str]]:
+    # response gzip sudah otomatis (requests kirim Accept-Encoding + decode sendiri)
+    headers = {"Content-Type": "application/json"}
+    if len(body) > _GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def _raise_for_status(r: requests.Response) -> None:
     # jika error, lempar detail supaya Streamlit bisa tampilkan
     if r.status_code != 200:
         # coba parse json error
@@ -73,5 +206,3 @@ def chat(
         except Exception:
             detail = r.text
         raise APIError(f"HTTP {r.status_code}: {detail}")
-
-    return r.json()
@@ -1,42 +1,44 @@
 import os
 import sys
 
-import pandas as pd
 import streamlit as st
 
 # --- setup import ke package app ---
 ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, ROOT)
 
-# (signature lama dipertahankan, tapi tidak dipakai lagi)
-from app.agents.sql_agent import SQLAgent  # noqa: E402
-
 from app.services.api_client import APIConfig, APIError, chat, health_check  # noqa: E402
 
 
-# ---------- AGENT SINGLETON ----------
-@st.cache_resource
-def get_sql_agent() -> SQLAgent:
-    # legacy: sengaja tidak dipakai (biar tidak menjalankan agent lokal)
-    return SQLAgent()
+@st.cache_resource(show_spinner=False)
+def make_cfg(base_url: str, timeout: int) -> APIConfig:
+    # satu APIConfig (immutable) per (base_url, timeout), bukan objek baru tiap rerun
+    return APIConfig(base_url=base_url, timeout=timeout)
+
+
+@st.cache_data(show_spinner=False)
+def _resolve_api_base() -> str:
+    # lookup secrets + env sekali per proses (bukan per session); script utama
+    # dieksekusi ulang tiap rerun, jadi konstanta modul biasa tidak cukup
+    api_base = None
+    try:
+        api_base = st.secrets.get("API_BASE")  # type: ignore[attr-defined]
+    except Exception:
+        api_base = None
+    return api_base or os.getenv("API_BASE", "")
 
 
 def init_state():
     if "sql_state" not in st.session_state:
         st.session_state.sql_state = {}
     if "api_base" not in st.session_state:
-        api_base = None
-        try:
-            api_base = st.secrets.get("API_BASE")  # type: ignore[attr-defined]
-        except Exception:
-            api_base = None
-        if not api_base:
-            api_base = os.getenv("API_BASE", "")
-        st.session_state.api_base = api_base
+        st.session_state.api_base = _resolve_api_base()
     if "answer_lang" not in st.session_state:
         st.session_state.answer_lang = "id"
     if "show_debug" not in st.session_state:
         st.session_state.show_debug = True  # untuk SQL biasanya berguna
+    if "last_debug" not in st.session_state:
+        st.session_state.last_debug = None
 
 
 def _history_for_backend_sql() -> list[dict]:
@@ -65,44 +67,83 @@ def _extract_sql_preview(out: dict):
     if not isinstance(cols, list) or not isinstance(rows, list):
         return None
 
+    # rows = ChatState.last_sql_preview_rows, sudah dipotong backend (ChatAgent._truncate, 5 baris)
     return {"sql": last_sql, "columns": cols, "rows": rows}
 
 
-def main():
-    st.set_page_config(page_title="Olist SQL Assistant (Cloud Run)", layout="wide")
-    init_state()
+def _preview_table(columns: list, rows: list):
+    """
+    rows (list of list dari JSON) -> pyarrow.Table langsung per kolom, tanpa
+    inferensi dtype + BlockManager pandas; Streamlit kirim Arrow apa adanya.
+    Kolom dengan tipe campur (tidak bisa jadi satu Arrow type) -> fallback pandas.
+    Import lazy: session yang tidak pernah menampilkan preview tidak membayar import-nya.
+    """
+    import pyarrow as pa
 
-    st.title("🧮 Olist SQL Assistant (Cloud Run)")
-    st.caption("Streamlit frontend → Cloud Run backend (`/chat`) untuk pertanyaan numerik/SQL.")
+    try:
+        arrays = [pa.array([r[i] for r in rows]) for i in range(len(columns))]
+        return pa.Table.from_arrays(arrays, names=[str(c) for c in columns])
+    except (pa.ArrowException, IndexError, TypeError):
+        import pandas as pd
 
-    # ---------- SIDEBAR ----------
-    st.sidebar.header("Settings")
-    st.session_state.api_base = st.sidebar.text_input(
+        return pd.DataFrame(rows, columns=columns)
+
+
+@st.fragment
+def render_debug():
+    # hanya response terakhir; expander collapsed -> JSON besar tidak langsung dirender
+    if not st.session_state.show_debug or not st.session_state.last_debug:
+        return
+    with st.expander("Debug", expanded=False):
+        st.json(st.session_state.last_debug)
+
+
+@st.fragment
+def render_sidebar():
+    # dipanggil di dalam `with st.sidebar:` (fragment tidak boleh memanggil st.sidebar langsung)
+    st.header("Settings")
+    st.session_state.api_base = st.text_input(
         "Cloud Run Base URL",
         value=st.session_state.api_base,
         placeholder="https://<service>.run.app",
     )
-    st.session_state.answer_lang = st.sidebar.selectbox(
+    st.session_state.answer_lang = st.selectbox(
         "Answer language", ["id", "en"], index=0 if st.session_state.answer_lang == "id" else 1
     )
-    st.session_state.show_debug = st.sidebar.checkbox("Show debug", value=st.session_state.show_debug)
+    st.session_state.show_debug = st.checkbox("Show debug", value=st.session_state.show_debug)
 
-    cfg = APIConfig(base_url=st.session_state.api_base, timeout=120)
+    cfg = make_cfg(st.session_state.api_base, 120)
 
-    c1, c2 = st.sidebar.columns(2)
+    c1, c2 = st.columns(2)
     with c1:
         if st.button("Check /health"):
             if not cfg.base_url:
-                st.sidebar.error("API_BASE belum diisi.")
+                st.error("API_BASE belum diisi.")
             else:
                 code, body = health_check(cfg)
-                st.sidebar.write("Status:", code)
-                st.sidebar.write(body)
+                st.write("Status:", code)
+                st.write(body)
     with c2:
         if st.button("Clear state"):
             st.session_state.sql_state = {}
+            st.session_state.last_debug = None
             st.rerun()
 
+
+def main():
+    st.set_page_config(page_title="Olist SQL Assistant (Cloud Run)", layout="wide")
+    init_state()
+
+    st.title("🧮 Olist SQL Assistant (Cloud Run)")
+    st.caption("Streamlit frontend → Cloud Run backend (`/chat`) untuk pertanyaan numerik/SQL.")
+
+    # ---------- SIDEBAR ----------
+    # fragment: edit sidebar / health check tidak menjalankan ulang main pane
+    with st.sidebar:
+        render_sidebar()
+
+    cfg = make_cfg(st.session_state.api_base, 120)
+
     # ---------- MAIN UI ----------
     st.subheader("Ask a question")
     q = st.text_area(
@@ -146,23 +187,20 @@ def main():
                     st.code(preview["sql"], language="sql")
 
                     st.subheader("Query preview")
-                    df = pd.DataFrame(preview["rows"], columns=preview["columns"])
-                    st.dataframe(df, use_container_width=True, hide_index=True)
+                    tbl = _preview_table(preview["columns"], preview["rows"])
+                    st.dataframe(tbl, use_container_width=True, hide_index=True)
                 else:
                     st.info("Backend tidak mengembalikan SQL preview untuk pertanyaan ini (mungkin bukan intent SQL).")
 
                 # debug opsional
                 if st.session_state.show_debug:
-                    st.divider()
-                    st.subheader("Debug")
-                    st.json(
-                        {
-                            "used_tools": out.get("used_tools", []),
-                            "debug": out.get("debug", {}),
-                            "state": out.get("state", {}),
-                            "tool_outputs": out.get("tool_outputs", {}),
-                        }
-                    )
+                    st.session_state.last_debug = {
+                        "used_tools": out.get("used_tools", []),
+                        "debug": out.get("debug", {}),
+                        "state": out.get("state", {}),
+                        "tool_outputs": out.get("tool_outputs", {}),
+                    }
+                    render_debug()
 
             except APIError as e:
                 st.error(str(e))
@@ -0,0 +1,109 @@
+"""
+Few-shot training untuk classifier intent SetFit (dipakai app/agents/intent_setfit.py).
+
+    python -m app.train_intent_setfit --out models/intent_setfit
+    export INTENT_MODEL_PATH=models/intent_setfit
+
+Butuh `pip install setfit` (ikut torch + sentence-transformers); tidak masuk requirements.
+Urutan label disimpan ke `intent_labels.json` di folder model; loader menolak model tanpa file ini.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+from app.agents.intent_setfit import INTENT_LABELS, LABELS_FILE, canonical_message
+
+BASE_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+# contoh few-shot (Indonesia + English), selaras dengan definisi intent di router LLM ChatAgent
+FEW_SHOT_EXAMPLES = {
+    "sql": [
+        "berapa jumlah order untuk kategori electronics",
+        "top 10 kategori dengan review score tertinggi",
+        "rata-rata review score per kota seller",
+        "how many items were sold in computers_accessories",
+        "total order per product category",
+        "which seller city has the most orders",
+        "jumlah produk yang direview dengan skor 1",
+        "average review score for toys",
+    ],
+    "rag": [
+        "produk apa yang direkomendasikan untuk hadiah anak",
+        "apa kata pembeli tentang kualitas produk furniture",
+        "recommend a good product for home office",
+        "describe the reviews for health beauty products",
+        "cari produk yang sering dipuji soal pengiriman cepat",
+        "what do customers complain about in bed bath table",
+        "produk mana yang cocok untuk hobi memasak",
+        "show reviews mentioning broken items",
+    ],
+    "analytics": [
+        "lakukan analisis eda pada dataset order",
+        "berikan insight bisnis dari data olist",
+        "analyze the dataset and summarize key trends",
+        "give me an overview of sales patterns",
+        "rangkum temuan utama dari data penjualan",
+        "run an exploratory analysis on delivery times",
+        "insight apa yang bisa diambil dari data review",
+        "analyze seasonality of orders",
+    ],
+    "hybrid": [
+        "kenapa kategori electronics punya review score rendah",
+        "jelaskan mengapa penjualan furniture turun dan apa kata pembeli",
+        "why do toys have the lowest ratings and what do reviews say",
+        "top kategori dengan review buruk dan alasannya",
+        "which categories sell the most and why do customers like them",
+        "berapa order kategori sports dan apa keluhan utamanya",
+        "explain the low average score for office furniture",
+        "kategori mana yang paling laku dan kenapa disukai",
+    ],
+    "general": [
+        "halo apa kabar",
+        "terima kasih banyak",
+        "hi there",
+        "kamu bisa bantu apa saja",
+        "what can you do",
+        "siapa yang membuat chatbot ini",
+        "good morning",
+        "oke makasih ya",
+    ],
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train SetFit intent classifier")
+    parser.add_argument("--out", required=True, type=Path, help="folder output (INTENT_MODEL_PATH)")
+    parser.add_argument("--base-model", default=BASE_MODEL)
+    parser.add_argument("--epochs", type=int, default=1)
+    args = parser.parse_args()
+
+    from datasets import Dataset
+    from setfit import SetFitModel, Trainer, TrainingArguments
+
+    labels = list(INTENT_LABELS)
+    texts, label_ids = [], []
+    for label, examples in FEW_SHOT_EXAMPLES.items():
+        for text in examples:
+            # fitur sama dengan saat predict (canonical_message)
+            texts.append(canonical_message(text))
+            label_ids.append(labels.index(label))
+
+    # label id = index di `labels` -> kolom predict_proba (classes_ terurut 0..n-1) = urutan `labels`
+    model = SetFitModel.from_pretrained(args.base_model, labels=labels)
+    trainer = Trainer(
+        model=model,
+        args=TrainingArguments(batch_size=16, num_epochs=args.epochs),
+        train_dataset=Dataset.from_dict({"text": texts, "label": label_ids}),
+    )
+    trainer.train()
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(str(args.out))
+    (args.out / LABELS_FILE).write_text(json.dumps(labels), encoding="utf-8")
+    print(f"Saved SetFit intent model ({len(texts)} examples) to {args.out}")
+
+
+if __name__ == "__main__":
+    main()